@@ -0,0 +1,136 @@
+"""
+Compare the packed lock encoding with the hash layout used before: Python
+encode/decode cost, pipelined write/read cost including Redis and memory per lock.
+
+    python -m benchmarks.bench_encoding --redis redis://localhost/15
+"""
+import argparse
+import time
+
+import arrow
+from attr import asdict
+from redis import StrictRedis
+
+from rlock.lock import decode_lock, encode_lock, Lock, LOCK_FIELDS
+
+
+def make_locks(count: int) -> list:
+    now = arrow.now().timestamp
+    return [
+        Lock(
+            user_id=f"U{i:08d}",
+            channel_id=f"C{i:08d}",
+            expiry_tstamp=now + 3000,
+            init_tstamp=now,
+            message_id=f"{now}.{i:06d}",
+            extra_msg="deploying release 1.2.3",
+            version=i,
+        )
+        for i in range(count)
+    ]
+
+
+def decode_hash(vals: list) -> Lock:
+    values = dict(zip(LOCK_FIELDS, vals))
+    return Lock(
+        user_id=values["user_id"].decode("utf-8"),
+        channel_id=values["channel_id"].decode("utf-8"),
+        expiry_tstamp=int(values["expiry_tstamp"]),
+        init_tstamp=int(values["init_tstamp"]),
+        user_notified=int(values["user_notified"] or 0),
+        channel_notified=int(values["channel_notified"] or 0),
+        message_id=values["message_id"] and values["message_id"].decode("utf-8"),
+        extra_msg=values["extra_msg"] and values["extra_msg"].decode("utf-8"),
+        version=int(values["version"] or 0),
+    )
+
+
+def timed(func, items: list) -> float:
+    """
+    Return microseconds per item.
+    """
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def bench_hash(client: StrictRedis, locks: list) -> dict:
+    pipe = client.pipeline(transaction=False)
+    start = time.perf_counter()
+    for lock in locks:
+        pipe.hmset(f"bench_{lock.full_id}", asdict(lock))
+    pipe.execute()
+    write = (time.perf_counter() - start) / len(locks) * 1e6
+
+    start = time.perf_counter()
+    for lock in locks:
+        pipe.hmget(f"bench_{lock.full_id}", LOCK_FIELDS)
+    raw = pipe.execute()
+    [decode_hash(vals) for vals in raw]
+    read = (time.perf_counter() - start) / len(locks) * 1e6
+
+    return {
+        "encode": timed(asdict, locks),
+        "decode": timed(decode_hash, raw),
+        "write": write,
+        "read": read,
+        "bytes": memory(client, locks),
+    }
+
+
+def bench_packed(client: StrictRedis, locks: list) -> dict:
+    pipe = client.pipeline(transaction=False)
+    start = time.perf_counter()
+    for lock in locks:
+        pipe.set(f"bench_{lock.full_id}", encode_lock(lock))
+    pipe.execute()
+    write = (time.perf_counter() - start) / len(locks) * 1e6
+
+    start = time.perf_counter()
+    for lock in locks:
+        pipe.get(f"bench_{lock.full_id}")
+    raw = pipe.execute()
+    [decode_lock(packed) for packed in raw]
+    read = (time.perf_counter() - start) / len(locks) * 1e6
+
+    return {
+        "encode": timed(encode_lock, locks),
+        "decode": timed(decode_lock, raw),
+        "write": write,
+        "read": read,
+        "bytes": memory(client, locks),
+    }
+
+
+def memory(client: StrictRedis, locks: list) -> float:
+    pipe = client.pipeline(transaction=False)
+    for lock in locks:
+        pipe.execute_command("MEMORY", "USAGE", f"bench_{lock.full_id}")
+    usage = pipe.execute()
+
+    for lock in locks:
+        pipe.delete(f"bench_{lock.full_id}")
+    pipe.execute()
+    return sum(usage) / len(usage)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis", default="redis://localhost/15")
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    client = StrictRedis.from_url(args.redis)
+    locks = make_locks(args.count)
+    columns = ["encode", "decode", "write", "read"]
+    print(f"{'layout':8}", *[f"{x + ' us':>10}" for x in columns], "bytes/lock")
+    for name, bench in (("hash", bench_hash), ("packed", bench_packed)):
+        res = bench(client, locks)
+        print(
+            f"{name:8}", *[f"{res[x]:10.2f}" for x in columns], f"{res['bytes']:10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Drive /lock, /dialock and /unlock through the app against a local Redis and
+a fake Slack server, report latency, throughput & Redis commands per request.
+
+    python -m benchmarks.bench_requests --redis redis://localhost/15 --latency 0.05
+
+The Redis database is flushed, dont point it to one with real data.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import requests
+
+from .fake_slack import FakeSlack
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "requests.json")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def start_app(port: int):
+    import uvicorn
+    from rlock.webserver import app
+
+    class Server(uvicorn.Server):
+        def install_signal_handlers(self):
+            pass  # not running in the main thread
+
+    server = Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def slash_command(team: str, channel: str, user: str, text: str = "") -> dict:
+    return {
+        "team_id": team,
+        "channel_id": channel,
+        "user_id": user,
+        "text": text,
+        "command": "/rlock",
+        "trigger_id": uuid.uuid4().hex,
+    }
+
+
+def dialog_action(channel: str, user: str, value: str) -> dict:
+    payload = {
+        "callback_id": "lock_expiry",
+        "channel": {"id": channel},
+        "user": {"id": user},
+        "actions": [{"value": value}],
+        "action_ts": uuid.uuid4().hex,
+    }
+    return {"payload": json.dumps(payload)}
+
+
+def scenario(team: str, channel: str, owner: str, waiter: str) -> list:
+    """
+    One lock lifetime in a channel: lock, someone queues, extend, unlock.
+    """
+    return [
+        ("lock", "/lock", slash_command(team, channel, owner, "30 release")),
+        ("lock_queued", "/lock", slash_command(team, channel, waiter)),
+        ("dialock", "/dialock", dialog_action(channel, owner, "lock_20")),
+        ("lock_extend", "/lock", slash_command(team, channel, owner, "10")),
+        ("unlock", "/unlock", slash_command(team, channel, owner)),
+    ]
+
+
+def run(args) -> Dict[str, float]:
+    from redis import StrictRedis
+    from rlock import config
+
+    redis = StrictRedis.from_url(args.redis)
+    redis.flushdb()
+    server = start_app(args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+    local = threading.local()
+    latencies: Dict[str, List[float]] = {}
+
+    def play(index: int):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        channel = f"C{index % args.channels:08d}"
+        steps = scenario(config.SLACK_TEAM, channel, f"U{index:08d}", f"W{index:08d}")
+        for name, path, data in steps:
+            start = time.perf_counter()
+            res = local.session.post(base_url + path, data=data)
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if res.status_code >= 500:
+                raise RuntimeError(f"{path} failed: {res.status_code}")
+
+    commands_before = redis.info("stats")["total_commands_processed"]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(play, range(args.iterations)))
+    elapsed = time.perf_counter() - start
+    commands = redis.info("stats")["total_commands_processed"] - commands_before
+    server.should_exit = True
+
+    total = sum(len(x) for x in latencies.values())
+    everything = [x for values in latencies.values() for x in values]
+    results = {
+        "requests_per_sec": total / elapsed,
+        "redis_commands_per_request": commands / total,
+        "p50_ms": percentile(everything, 50) * 1000,
+        "p99_ms": percentile(everything, 99) * 1000,
+    }
+    for name, values in sorted(latencies.items()):
+        results[f"{name}_p50_ms"] = percentile(values, 50) * 1000
+        results[f"{name}_p99_ms"] = percentile(values, 99) * 1000
+    return results
+
+
+def compare(results: Dict[str, float], path: str, tolerance: float) -> bool:
+    """
+    Print results next to the saved baseline, return False on regressions.
+    """
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+
+    ok = True
+    for name, value in results.items():
+        line = f"{name:32} {value:10.2f}"
+        if name in baseline and baseline[name]:
+            change = (value - baseline[name]) / baseline[name]
+            higher_is_better = name == "requests_per_sec"
+            regressed = -change > tolerance if higher_is_better else change > tolerance
+            ok = ok and not regressed
+            line += f" {change:+8.1%}{'  REGRESSION' if regressed else ''}"
+        print(line)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis", default="redis://localhost/15")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="Slack, seconds")
+    parser.add_argument("--ratelimit", type=float, default=0.0, help="ratio of 429s")
+    parser.add_argument(
+        "--pacing", action="store_true", help="keep Slack calls within rate limits"
+    )
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save", action="store_true", help="store as new baseline")
+    args = parser.parse_args()
+
+    slack = FakeSlack(latency=args.latency, ratelimit=args.ratelimit).start()
+    os.environ["REDIS_DB"] = args.redis
+    os.environ["SLACK_API_URL"] = slack.url
+    os.environ["SLACK_PACING"] = "true" if args.pacing else "false"
+
+    results = run(args)
+    ok = compare(results, args.baseline, args.tolerance)
+    print("slack calls:", dict(slack.calls), "ratelimited:", dict(slack.ratelimited))
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
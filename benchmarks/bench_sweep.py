@@ -0,0 +1,228 @@
+"""
+Fill Redis with synthetic channel populations & time the tasker sweeps over them:
+the expiry check run every SWEEP_INTERVAL minutes & the daily stats report.
+Slack calls are counted by stubs instead of being sent.
+
+    python -m benchmarks.bench_sweep --redis redis://localhost/15 --channels 100000
+
+The Redis database is flushed, dont point it to one with real data.
+"""
+import argparse
+from collections import Counter
+import os
+import random
+import time
+from typing import Dict
+
+BATCH = 10000
+
+
+class Timer:
+    """
+    Accumulate time spent in a wrapped function.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+
+
+def populate(args) -> Counter:
+    """
+    Store locks with expiries picked by the given ratios & today stats.
+    """
+    import arrow
+    from rlock import config
+    from rlock.channel_stats import active_key, stats_key
+    from rlock.lock import client, encode_lock, index_lock, Lock
+
+    now = arrow.now().timestamp
+    warn = config.EXPIRY_WARN * 60
+    kinds: Counter = Counter()
+    pipe = client.pipeline(transaction=False)
+    for i in range(args.channels):
+        roll = random.random()
+        if roll < args.expired:
+            kind, expiry = "expired", now - random.randint(1, 3600)
+        elif roll < args.expired + args.warning:
+            kind, expiry = "warning", now + random.randint(1, warn - 1)
+        else:
+            kind, expiry = "active", now + warn + random.randint(1, args.spread)
+        kinds[kind] += 1
+
+        lock = Lock(
+            user_id=f"U{i:08d}",
+            channel_id=f"C{i:08d}",
+            expiry_tstamp=expiry,
+            init_tstamp=now - 1800,
+            message_id=f"{now}.{i:06d}",
+            extra_msg="deploying release 1.2.3",
+            version=i,
+        )
+        pipe.set(lock.full_id, encode_lock(lock))
+        index_lock(lock, pipe)
+        if random.random() < args.subscribed:
+            pipe.zadd(lock.ping_id, now, f"W{i:08d}")
+        if random.random() < args.stats:
+            pipe.sadd(active_key(now), lock.channel_id)
+            pipe.hmset(
+                stats_key(lock.channel_id, now),
+                {
+                    "channel_id": lock.channel_id,
+                    "created_tstamp": now,
+                    "locks_count": random.randint(1, 20),
+                    "extends_count": random.randint(0, 20),
+                    "lock_minutes": random.randint(30, 600),
+                    "longest_lock": random.randint(30, 120),
+                },
+            )
+        if i % BATCH == BATCH - 1:
+            pipe.execute()
+    pipe.execute()
+    return kinds
+
+
+def stub_slack() -> Counter:
+    """
+    Replace functions talking to Slack by ones just counting the calls.
+    """
+    from rlock import channel_stats, slackbot, tasker
+
+    calls: Counter = Counter()
+
+    def channel_message(
+        channel, message, init_lock=False, user=None, priority=None, resource=None
+    ):
+        calls["ephemeral" if user else "message"] += 1
+        return True, f"{time.time()}"
+
+    def update_channel_message(lock, message, unlock=False):
+        calls["update"] += 1
+        return True, lock.message_id
+
+    tasker.channel_message = channel_message
+    channel_stats.channel_message = channel_message
+    slackbot.update_channel_message = update_channel_message
+    return calls
+
+
+def sweep(run, redis_commands) -> Dict[str, float]:
+    """
+    Time one run of a tasker sweep, split into its parts.
+    """
+    from rlock import lock, tasker
+
+    decode = Timer(lock.decode_lock)
+    due = Timer(tasker.get_due_channels)
+    fetch = Timer(tasker.get_locks)
+    check = Timer(tasker.check_channel_expiration)
+    stats = Timer(tasker.load_stats_batch)
+    lock.decode_lock = decode
+    tasker.get_due_channels, tasker.get_locks = due, fetch
+    tasker.check_channel_expiration, tasker.load_stats_batch = check, stats
+
+    commands = redis_commands()
+    start = time.perf_counter()
+    try:
+        run()
+    finally:
+        total = time.perf_counter() - start
+        lock.decode_lock = decode.func
+        tasker.get_due_channels, tasker.get_locks = due.func, fetch.func
+        tasker.check_channel_expiration = check.func
+        tasker.load_stats_batch = stats.func
+
+    return {
+        "total_s": total,
+        "index_s": due.seconds,
+        "fetch_s": fetch.seconds,
+        "decode_s": decode.seconds,  # of all locks read, also by the checks
+        "act_s": check.seconds,
+        "stats_s": stats.seconds,
+        "locks_acted_on": check.calls,
+        "stats_batches": stats.calls,
+        "redis_commands": redis_commands() - commands,
+    }
+
+
+def report(name: str, results: Dict[str, float], calls: Counter, budget: float):
+    print(f"\n{name}")
+    for key, value in results.items():
+        print(
+            f"  {key:20} {value:12.3f}"
+            if key.endswith("_s")
+            else f"  {key:20} {value:12}"
+        )
+    print(f"  {'slack calls':20} {dict(calls)}")
+    if budget:
+        fits = "fits" if results["total_s"] < budget else "DOES NOT FIT"
+        print(f"  {fits} in the {budget:.0f}s between sweeps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis", default="redis://localhost/15")
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument(
+        "--expired", type=float, default=0.05, help="ratio of already expired locks"
+    )
+    parser.add_argument(
+        "--warning", type=float, default=0.05, help="ratio of locks about to expire"
+    )
+    parser.add_argument(
+        "--spread", type=int, default=86400, help="expiry range of other locks, s"
+    )
+    parser.add_argument(
+        "--subscribed", type=float, default=0.2, help="ratio of locks with a queue"
+    )
+    parser.add_argument(
+        "--stats", type=float, default=1.0, help="ratio of channels with stats today"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ["REDIS_DB"] = args.redis
+    random.seed(args.seed)
+
+    from rlock import config, tasker
+    from rlock.lock import client
+
+    client.flushdb()
+    start = time.perf_counter()
+    kinds = populate(args)
+    print(
+        f"stored {args.channels} channels in {time.perf_counter() - start:.1f}s:",
+        dict(kinds),
+        f"{client.info('memory')['used_memory_human']} used",
+    )
+
+    def redis_commands() -> int:
+        return client.info("stats")["total_commands_processed"]
+
+    calls = stub_slack()
+    tasker.huey.immediate = True  # run tasks split off by the sweeps right away
+    results = sweep(tasker.check_expirations.call_local, redis_commands)
+    report("check_expirations", results, calls, config.SWEEP_INTERVAL * 60)
+
+    def daily_stats():
+        tasker.check_daily_stats.call_local()
+        for task in tasker.huey.scheduled():  # posts spread out by the report rate
+            if isinstance(task, tasker.post_stats.task_class):
+                task.execute()
+
+    calls.clear()
+    results = sweep(daily_stats, redis_commands)
+    report("check_daily_stats", results, calls, 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Local stand-in for the Slack Web API with configurable latency & rate limiting.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+
+
+class FakeSlack(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, ratelimit: float = 0.0, port: int = 0):
+        """
+        :param latency: seconds to wait before answering
+        :param ratelimit: ratio of calls answered by 429 Too Many Requests
+        """
+        super().__init__(("127.0.0.1", port), SlackHandler)
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.calls: Counter = Counter()
+        self.ratelimited: Counter = Counter()
+        self.counter_lock = threading.Lock()
+        self.ts = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api"
+
+    def next_ts(self) -> str:
+        with self.counter_lock:
+            self.ts += 1
+            return f"{int(time.time())}.{self.ts:06d}"
+
+    def start(self) -> "FakeSlack":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class SlackHandler(BaseHTTPRequestHandler):
+    server: FakeSlack
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.server.latency)
+
+        if random.random() < self.server.ratelimit:
+            self.server.ratelimited[method] += 1
+            self.respond(
+                429, {"ok": False, "error": "ratelimited"}, {"Retry-After": "1"}
+            )
+            return
+
+        self.server.calls[method] += 1
+        res = {"ok": True}
+        if method in ("chat.postMessage", "chat.update"):
+            res["ts"] = self.server.next_ts()
+        elif method == "im.open":
+            res["channel"] = {"id": "D00000000"}
+        self.respond(200, res)
+
+    def respond(self, status: int, data: dict, headers: dict = None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
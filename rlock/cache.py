@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import copy
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from redis.exceptions import ConnectionError
+
+from . import config
+
+client = config.get_redis()
+
+MISSING = object()
+
+caches: Dict[str, "ReadCache"] = {}
+
+
+class ReadCache:
+    """
+    In-process LRU cache of decoded objects with TTL. Writers invalidate the
+    entries via Redis pub/sub so caches of all app replicas stay coherent.
+    """
+
+    def __init__(self, name: str, size: int, ttl: float):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def token(self) -> int:
+        """
+        Take before reading from Redis, entries invalidated meanwhile wont be set.
+        """
+        return self.evictions
+
+    def get(self, key: str) -> Any:
+        if not self.enabled:
+            return MISSING
+
+        start_listener()
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return MISSING
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return copy.copy(item[1])
+
+    def set(self, key: str, value: Any, token: int) -> None:
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if token != self.evictions:
+                return
+
+            self.items[key] = (time.monotonic() + self.ttl, copy.copy(value))
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def evict(self, key: Optional[str] = None) -> None:
+        with self.lock:
+            self.evictions += 1
+            if key is None:
+                self.items.clear()
+            else:
+                self.items.pop(key, None)
+
+    def invalidate(self, key: str, pipe=None) -> None:
+        """
+        Drop the entry here & in other processes, which may have the cache
+        enabled even when this one doesn't.
+        """
+        if self.enabled:
+            self.evict(key)
+        message = self.invalidation(key)
+        if message:
+            (pipe or client).publish(config.CACHE_CHANNEL, message)
+
+    def invalidation(self, *keys: str) -> str:
+        """
+        Return message dropping the entries in other processes, for scripts to
+        publish along with their change. Empty when no process caches them.
+        """
+        if not config.CACHE_INVALIDATE:
+            return ""
+        return "\n".join(f"{self.name}:{key}" for key in keys)
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {
+        name: {"hits": cache.hits, "misses": cache.misses, "size": len(cache.items)}
+        for name, cache in caches.items()
+    }
+
+
+listener: Optional[threading.Thread] = None
+listener_lock = threading.Lock()
+
+
+def start_listener():
+    global listener
+    if listener is not None:
+        return
+
+    with listener_lock:
+        if listener is None:
+            listener = threading.Thread(target=listen_invalidations, daemon=True)
+            listener.start()
+
+
+def listen_invalidations():
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(config.CACHE_CHANNEL)
+            for cache in caches.values():  # missed messages while not subscribed
+                cache.evict()
+
+            for message in pubsub.listen():
+                for entry in message["data"].decode("utf-8").splitlines():
+                    name, _, key = entry.partition(":")
+                    if name in caches:
+                        caches[name].evict(key)
+        except ConnectionError:
+            time.sleep(1)
@@ -1,11 +1,14 @@
 from datetime import date
 
 import arrow
-from typing import Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import attr
 
-from .slackbot import channel_message
+from .lock import Lock
+from .metrics import observe_redis
+from .scripts import LOCK_END_STATS
+from .slackbot import channel_message, PRIORITY_LOW
 from . import config
 
 client = config.get_redis()
@@ -20,7 +23,7 @@ STATS_FIELDS = [
 ]
 
 
-@attr.s
+@attr.s(slots=True)
 class ChannelStats:
     channel_id: str = attr.ib()
     created_tstamp: int = attr.ib()
@@ -31,54 +34,86 @@ class ChannelStats:
 
     @property
     def full_id(self):
-        return f"{config.CHANNEL_STATS_PREFIX}{self.channel_id}"
-
-    def mark_extend(self, save=False) -> None:
-        self.extends_count += 1
-        if save:
-            save_stats(self)
-
-    def mark_lock(self, save=False) -> None:
-        self.locks_count += 1
-        if save:
-            save_stats(self)
+        return stats_key(self.channel_id, self.created_tstamp)
 
     @property
     def is_today(self) -> bool:
-        record = arrow.get(self.created_tstamp)
+        record = arrow.get(self.created_tstamp).to("local")
         return record.date() == date.today()
 
 
-def get_stats(channel_id: str) -> ChannelStats:
-    key_name = f"{config.CHANNEL_STATS_PREFIX}{channel_id}"
-    vals = client.hmget(key_name, STATS_FIELDS)
-    stats = None
-    if any(vals):
-        values = dict(zip(STATS_FIELDS, vals))
-        stats = ChannelStats(
-            channel_id=values["channel_id"] and values["channel_id"].decode("utf-8"),
-            created_tstamp=int(values["created_tstamp"]) or 0,
-            locks_count=int(values["locks_count"]) or 0,
-            extends_count=int(values["extends_count"]) or 0,
-            lock_minutes=int(values["lock_minutes"]) or 0,
-            longest_lock=int(values["longest_lock"]) or 0,
-        )
-
-        if not stats.is_today:
-            remove_stats(stats)
-            stats = None
-
-    if not stats:
-        stats = ChannelStats(
-            channel_id=channel_id,
-            created_tstamp=arrow.now().timestamp,
-            locks_count=0,
-            extends_count=0,
-            lock_minutes=0,
-            longest_lock=0,
-        )
-
-    return stats
+def stats_key(channel_id: str, tstamp: int) -> str:
+    """
+    Stats are kept per day, in local time.
+    """
+    day = arrow.get(tstamp).to("local").format("YYYY-MM-DD")
+    return f"{config.CHANNEL_STATS_PREFIX}{channel_id}:{day}"
+
+
+def active_key(tstamp: int) -> str:
+    """
+    Set of channels with any lock in the day.
+    """
+    day = arrow.get(tstamp).to("local").format("YYYY-MM-DD")
+    return f"{config.ACTIVE_CHANNELS_PREFIX}{day}"
+
+
+def stats_expiry(tstamp: int) -> int:
+    """
+    Return timestamp when stats of the day are dropped.
+    """
+    day_end = arrow.get(tstamp).to("local").ceil("day").timestamp
+    return day_end + config.STATS_RETENTION * 24 * 3600
+
+
+@observe_redis
+def get_stats(channel_id: str, tstamp: Optional[int] = None) -> ChannelStats:
+    """
+    Return stats of a channel for the day of given timestamp, today by default.
+    """
+    tstamp = tstamp or arrow.now().timestamp
+    vals = client.hmget(stats_key(channel_id, tstamp), STATS_FIELDS)
+    return decode_stats(channel_id, tstamp, vals)
+
+
+@observe_redis
+def load_stats_batch(channel_ids: List[str], tstamp: int) -> List[ChannelStats]:
+    """
+    Return stats of the channels for the day, fetched in a single round trip.
+    """
+    pipe = client.pipeline(transaction=False)
+    for channel_id in channel_ids:
+        pipe.hmget(stats_key(channel_id, tstamp), STATS_FIELDS)
+    return [
+        decode_stats(channel_id, tstamp, vals)
+        for channel_id, vals in zip(channel_ids, pipe.execute())
+    ]
+
+
+def iter_active_channels(tstamp: int, batch: int) -> Iterator[List[str]]:
+    """
+    Yield channels with any lock in the day, in batches of about given size.
+    """
+    channel_ids: List[str] = []
+    for channel_id in client.sscan_iter(active_key(tstamp), count=batch):
+        channel_ids.append(channel_id.decode("utf-8"))
+        if len(channel_ids) >= batch:
+            yield channel_ids
+            channel_ids = []
+    if channel_ids:
+        yield channel_ids
+
+
+def decode_stats(channel_id: str, tstamp: int, vals: list) -> ChannelStats:
+    values = dict(zip(STATS_FIELDS, vals))
+    return ChannelStats(
+        channel_id=channel_id,
+        created_tstamp=int(values["created_tstamp"] or tstamp),
+        locks_count=int(values["locks_count"] or 0),
+        extends_count=int(values["extends_count"] or 0),
+        lock_minutes=int(values["lock_minutes"] or 0),
+        longest_lock=int(values["longest_lock"] or 0),
+    )
 
 
 def print_stats(stats: ChannelStats) -> Tuple[bool, str]:
@@ -89,12 +124,19 @@ def print_stats(stats: ChannelStats) -> Tuple[bool, str]:
             f"number of lock extends: {stats.extends_count}",
         ]
     )
-    return channel_message(stats.channel_id, message)
-
-
-def remove_stats(stats: ChannelStats):
-    client.hdel(stats.full_id, *STATS_FIELDS)
+    return channel_message(stats.channel_id, message, priority=PRIORITY_LOW)
+
+
+@observe_redis
+def record_lock_end(lock: Lock, ended: int):
+    """
+    Add the time the lock was held for into stats of the day it ended.
+    """
+    key_name = stats_key(lock.channel_id, ended)
+    minutes = max(0, int((ended - lock.init_tstamp) / 60))
+    lock_end_script(
+        keys=[key_name], args=[lock.channel_id, ended, minutes, stats_expiry(ended)]
+    )
 
 
-def save_stats(stats: ChannelStats) -> bool:
-    return client.hmset(stats.full_id, attr.asdict(stats))
+lock_end_script = client.register_script(LOCK_END_STATS)
@@ -1,21 +1,87 @@
 from collections import defaultdict
 
 from envparse import env
-from redis import StrictRedis
+from redis import BlockingConnectionPool, StrictRedis
+import requests
+from requests.adapters import HTTPAdapter
 from slackclient import SlackClient
-from typing import DefaultDict
+from slackclient.slackrequest import SlackRequest
+from typing import DefaultDict, Optional
 
 SLACK_TEAM = env("SLACK_TEAM", "team")
 SLACK_BOT_TOKEN = env("SLACK_BOT_TOKEN", "token")
 SLACK_TESTUSER = env("SLACK_TESTUSER", "U40L9UPKK")
+SLACK_API_URL = env("SLACK_API_URL", "https://slack.com/api")
 
 REDIS_DB = env("REDIS_DB", "redis://redis/0")
+WORKER_THREADS = env.int("WORKER_THREADS", default=20)  # blocking I/O of requests
+REDIS_POOL_SIZE = env.int("REDIS_POOL_SIZE", default=WORKER_THREADS + 10)
+SLACK_POOL_SIZE = env.int("SLACK_POOL_SIZE", default=WORKER_THREADS)
+SLACK_TIMEOUT = env.float("SLACK_TIMEOUT", default=5.0)  # seconds
+# requests per minute allowed by Slack API rate limit tiers
+SLACK_RATE_LIMITS = {
+    "chat.postMessage": 60,
+    "chat.postEphemeral": 100,
+    "chat.update": 50,
+    "reactions.add": 50,
+    "im.open": 100,
+}
+SLACK_CHANNEL_RATE = 60  # messages per minute posted into a single channel
+SLACK_PACING = env.bool("SLACK_PACING", default=True)  # keep within the limits above
+SLACK_RATELIMIT_RETRIES = env.int("SLACK_RATELIMIT_RETRIES", default=5)
+# in-process cache of locks, disabled when size is 0
+CACHE_SIZE = env.int("CACHE_SIZE", default=0)
+CACHE_TTL = env.float("CACHE_TTL", default=5.0)  # seconds
+CACHE_CHANNEL = "rlock_cache_invalidate"  # pub/sub channel for invalidations
+# publish invalidations, needed when any replica has the cache enabled
+CACHE_INVALIDATE = env.bool("CACHE_INVALIDATE", default=CACHE_SIZE > 0)
+# answer slash commands right away & deliver Slack messages from the tasker
+SLACK_SEND_LATER = env.bool("SLACK_SEND_LATER", default=False)
+OUTBOX_RETRIES = env.int("OUTBOX_RETRIES", default=5)
+OUTBOX_RETRY_DELAY = env.int("OUTBOX_RETRY_DELAY", default=3)  # seconds
 LOCK_DURATION = 50  # minutes
 EXPIRY_WARN = 10  # minutes
+SWEEP_INTERVAL = env.int("SWEEP_INTERVAL", default=10)  # minutes, expiry safety net
 
 CHANNEL_PREFIX = "channel_lock_"  # prefix for redis
 CHANNEL_STATS_PREFIX = "channel_stats_"  # prefix for redis
-PING_PREFIX = "ping_"
+STATS_RETENTION = env.int("STATS_RETENTION", default=90)  # days to keep stats for
+ACTIVE_CHANNELS_PREFIX = "active_channels_"  # set of channels with locks in a day
+STATS_HOUR = env.int("STATS_HOUR", default=17)  # UTC hour of the daily report
+STATS_BATCH = env.int("STATS_BATCH", default=200)  # channels per report task
+STATS_RATE = env.int("STATS_RATE", default=30)  # report posts per minute
+EVENTS_STREAM = "lock_events"  # stream of all lock events
+EVENTS_MAXLEN = env.int("EVENTS_MAXLEN", default=100000)  # approx. events kept
+ROLLUP_PREFIX = "lock_rollup_"  # hourly counters of the events
+PING_PREFIX = "ping_"  # queue of users waiting for the lock
+READERS_PREFIX = "lock_readers_"  # users sharing a read lock
+EXPIRY_INDEX = "lock_expiry_index"  # sorted set of channel -> expiry timestamp
+WARN_INDEX = "lock_warn_index"  # sorted set of channel -> expiry warning timestamp
+LOCK_VERSION = "lock_version"  # counter for versions of locks
+SHADOW_PREFIX = "lock_ttl_"  # key expiring together with the lock, see listener
+LOCK_GRACE = 3600  # seconds to keep expired lock data around for announcing
+# minutes for the first one in queue to take over a released lock
+HANDOFF_WINDOW = env.int("HANDOFF_WINDOW", default=5)
+REFRESH_PREFIX = "lock_refresh_"  # claims of planned updates of lock messages
+# seconds to collect changes of the queue in, before updating the lock message
+REFRESH_DELAY = env.float("REFRESH_DELAY", default=2.0)
+EXTENSION_PREFIX = "lock_extended_"  # minutes of extensions not announced yet
+# seconds to merge announcements of extensions in, posted right away when 0
+EXTEND_MERGE = env.int("EXTEND_MERGE", default=30)
+ANNOUNCE_PREFIX = "lock_announced_"  # claims of expiry announcements by workers
+LEADER_KEY = "tasker_leader"  # lease of the tasker enqueueing periodic tasks
+LEADER_TTL = env.int("LEADER_TTL", default=15)  # seconds, renewed every third
+PERIODIC_PREFIX = "periodic_run_"  # claims of periodic task runs per minute
+IDEMPOTENCY_PREFIX = "request_"  # responses to requests, returned to their retries
+IDEMPOTENCY_TTL = env.int("IDEMPOTENCY_TTL", default=300)  # seconds
+# unlock expired locks on Redis keyspace notifications instead of scheduled tasks
+EXPIRY_EVENTS = env.bool("EXPIRY_EVENTS", default=False)
+SLOW_REQUEST_MS = env.int("SLOW_REQUEST_MS", default=1000)  # log trace when slower
+TRACING_OTEL = env.bool("TRACING_OTEL", default=False)  # mirror spans to OpenTelemetry
+# port of /metrics served by the tasker, disabled when 0
+TASKER_METRICS_PORT = env.int("TASKER_METRICS_PORT", default=0)
+# bearer token of the API for locking several channels at once, disabled if empty
+API_TOKEN = env("API_TOKEN", default="")
 SLACK_TESTS = env("SLACK_TESTS", False)  # if False, tests wont touch Slack
 
 LOCK_ICONS = defaultdict(lambda: "🔐")  # type: DefaultDict
@@ -23,9 +89,52 @@ LOCK_ICONS = defaultdict(lambda: "🔐")  # type: DefaultDict
 LOCK_ICONS.update({"U666KD6AX": ":tin_thinking:"})  # tin
 
 
+redis_pool: Optional[BlockingConnectionPool] = None
+
+
+class PooledSlackRequest(SlackRequest):
+    """
+    Slack API requester reusing connections instead of opening one per call.
+    """
+
+    def __init__(self, proxies=None):
+        super().__init__(proxies=proxies)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SLACK_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post_http_request(
+        self, token, api_method, post_data, files=None, timeout=None, domain="slack.com"
+    ):
+        if post_data is not None and "token" in post_data:
+            token = post_data["token"]
+
+        headers = {
+            "user-agent": self.get_user_agent(),
+            "Authorization": "Bearer {}".format(token),
+        }
+        return self.session.post(
+            "{0}/{1}".format(SLACK_API_URL, api_method),
+            headers=headers,
+            data=post_data,
+            files=files,
+            timeout=timeout or SLACK_TIMEOUT,
+            proxies=self.proxies,
+        )
+
+
 def get_redis():
-    return StrictRedis.from_url(REDIS_DB)
+    global redis_pool
+    if redis_pool is None:
+        redis_pool = BlockingConnectionPool.from_url(
+            REDIS_DB, max_connections=REDIS_POOL_SIZE
+        )
+
+    return StrictRedis(connection_pool=redis_pool)
 
 
 def get_slackbot():
-    return SlackClient(SLACK_BOT_TOKEN)
+    bot = SlackClient(SLACK_BOT_TOKEN)
+    bot.server.api_requester = PooledSlackRequest()
+    return bot
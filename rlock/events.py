@@ -0,0 +1,133 @@
+"""
+Append-only log of lock events in a Redis stream, with hourly rollups of
+per-channel & per-user counters, so the analytics dont need to rescan the log.
+"""
+from typing import Dict, List, Optional
+
+import arrow
+
+from . import config
+from .lock import EXPIRE, EXTENDED, Lock, LOCKED, QUEUED
+from .metrics import observe_redis
+
+client = config.get_redis()
+
+ACQUIRE = "acquire"
+EXTEND = "extend"
+QUEUE = "queue"
+UNLOCK = "unlock"
+HOLD_MINUTES = "hold_minutes"  # of unlocked & expired locks
+
+METRICS = [ACQUIRE, EXTEND, QUEUE, UNLOCK, EXPIRE, HOLD_MINUTES]
+STATUS_EVENTS = {LOCKED: ACQUIRE, EXTENDED: EXTEND, QUEUED: QUEUE}  # of acquire_lock
+
+
+def rollup_key(tstamp: int) -> str:
+    return f"{config.ROLLUP_PREFIX}{arrow.get(tstamp).format('YYYYMMDDHH')}"
+
+
+@observe_redis
+def record_event(
+    kind: str, lock: Lock, user_id: Optional[str] = None, now: Optional[int] = None
+):
+    """
+    Log the event & count it into the rollup of its hour, in one round trip.
+    `user_id` is the one who queued up, for the others it's the lock owner.
+    """
+    now = now or arrow.now().timestamp
+    user_id = user_id or lock.user_id
+    hold = 0
+    if kind in (UNLOCK, EXPIRE):
+        ended = lock.expiry_tstamp if kind == EXPIRE else now
+        hold = max(0, int((ended - lock.init_tstamp) / 60))
+
+    pipe = client.pipeline(transaction=False)
+    pipe.execute_command(
+        "XADD",
+        config.EVENTS_STREAM,
+        "MAXLEN",
+        "~",
+        config.EVENTS_MAXLEN,
+        "*",
+        "kind",
+        kind,
+        "channel_id",
+        lock.channel_id,
+        "resource",
+        lock.resource or "",
+        "user_id",
+        user_id,
+        "tstamp",
+        now,
+        HOLD_MINUTES,
+        hold,
+    )
+
+    key_name = rollup_key(now)
+    for metric, amount in ((kind, 1), (HOLD_MINUTES, hold)):
+        if not amount:
+            continue
+        pipe.hincrby(key_name, metric, amount)
+        pipe.hincrby(key_name, f"{metric}:c:{lock.channel_id}", amount)
+        pipe.hincrby(key_name, f"{metric}:u:{user_id}", amount)
+    pipe.expire(key_name, config.STATS_RETENTION * 24 * 3600)
+    pipe.execute()
+
+
+@observe_redis
+def get_rollup(
+    hours: int,
+    channel_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    until: Optional[int] = None,
+) -> dict:
+    """
+    Return counters per hour & in total for the last `hours`, of all locks or
+    only the ones of given channel / user, plus the most contended channels.
+    Filtered ones fetch just their counters, so only a given channel is listed
+    among the contended ones.
+    """
+    end = arrow.get(until or arrow.now().timestamp).floor("hour")
+    starts = [end.shift(hours=-x).timestamp for x in reversed(range(hours))]
+
+    suffix = f":c:{channel_id}" if channel_id else ""
+    suffix += f":u:{user_id}" if user_id and not channel_id else ""
+    fields = [f"{x}{suffix}" for x in METRICS]
+    pipe = client.pipeline(transaction=False)
+    for start in starts:
+        if suffix:
+            pipe.hmget(rollup_key(start), fields)
+        else:
+            pipe.hgetall(rollup_key(start))
+    rollups = pipe.execute()
+
+    by_hour = []
+    total: Dict[str, float] = dict.fromkeys(METRICS, 0)
+    contention: Dict[str, int] = {}
+    for start, rollup in zip(starts, rollups):
+        if suffix:
+            values = {x: int(y or 0) for x, y in zip(fields, rollup)}
+        else:
+            values = {x.decode("utf-8"): int(y) for x, y in rollup.items()}
+        hour = {x: values.get(f"{x}{suffix}", 0) for x in METRICS}
+        by_hour.append({"hour": arrow.get(start).isoformat(), **hour})
+        for metric in METRICS:
+            total[metric] += hour[metric]
+
+        for field, value in values.items():
+            if field.startswith(f"{QUEUE}:c:"):
+                channel = field[len(QUEUE) + 3 :]
+                contention[channel] = contention.get(channel, 0) + value
+
+    ended = total[UNLOCK] + total[EXPIRE]
+    total["avg_hold_minutes"] = round(total[HOLD_MINUTES] / ended, 1) if ended else 0
+    return {
+        "hours": by_hour,
+        "total": total,
+        "contended": top_channels(contention, 10),
+    }
+
+
+def top_channels(counts: Dict[str, int], limit: int) -> List[dict]:
+    ranked = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:limit]
+    return [{"channel_id": x, QUEUE: y} for x, y in ranked]
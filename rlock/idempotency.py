@@ -0,0 +1,79 @@
+"""
+Slack retries requests which werent answered in time. The first response to
+a request is kept in Redis for a while & returned to its retries, so they
+dont extend the lock again or post the same messages twice.
+"""
+import json
+from typing import Callable, Optional
+
+from starlette.responses import PlainTextResponse, Response
+
+from . import config
+from .metrics import DUPLICATE_REQUESTS, observe_redis
+
+client = config.get_redis()
+
+PENDING = b"pending"
+
+
+def request_key(endpoint: str, request_id: Optional[str]) -> Optional[str]:
+    if not request_id:
+        return None
+    return f"{config.IDEMPOTENCY_PREFIX}{endpoint}:{request_id}"
+
+
+@observe_redis
+def begin(key_name: str) -> Optional[Response]:
+    """
+    Claim the request, return response for the duplicates instead.
+    """
+    if client.set(key_name, PENDING, nx=True, ex=config.IDEMPOTENCY_TTL):
+        return None
+
+    stored = client.get(key_name)
+    if not stored or stored == PENDING:
+        # still being handled, it will answer on its own
+        return PlainTextResponse(None, status_code=204)
+
+    data = json.loads(stored)
+    return Response(data["body"], data["status"], media_type=data["media_type"])
+
+
+@observe_redis
+def finish(key_name: str, response: Response):
+    data = {
+        "body": response.body.decode("utf-8"),
+        "status": response.status_code,
+        "media_type": response.media_type,
+    }
+    client.set(key_name, json.dumps(data), ex=config.IDEMPOTENCY_TTL)
+
+
+@observe_redis
+def forget(key_name: str):
+    client.delete(key_name)
+
+
+def run_once(
+    endpoint: str, request_id: Optional[str], handler: Callable, *args
+) -> Response:
+    """
+    Handle the request unless it was handled already, then answer the same.
+    """
+    key_name = request_key(endpoint, request_id)
+    if not key_name:
+        return handler(*args)
+
+    response = begin(key_name)
+    if response is not None:
+        DUPLICATE_REQUESTS.labels(endpoint).inc()
+        return response
+
+    try:
+        response = handler(*args)
+    except Exception:
+        forget(key_name)  # let the retry try again
+        raise
+
+    finish(key_name, response)
+    return response
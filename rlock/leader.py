@@ -0,0 +1,114 @@
+"""
+Leader election among tasker replicas by a lease in Redis, so periodic tasks get
+enqueued by a single consumer. Every new leader gets a higher fencing token,
+a consumer whose lease lapsed cant renew it & has to campaign again.
+"""
+import os
+import socket
+import threading
+import time
+from typing import Optional
+import uuid
+
+from huey import RedisHuey
+
+from . import config
+from .metrics import LEADER_TOKEN
+from .scripts import ACQUIRE_LEASE, CLAIM_RUN, RELEASE_LEASE
+
+client = config.get_redis()
+
+
+class LeaderElection:
+    def __init__(self, key: str, ttl: int):
+        self.key = key
+        self.ttl = ttl
+        self.identity = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.token: Optional[int] = None
+        self.valid_until = 0.0
+        self.heartbeat: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self.valid_until
+
+    def campaign(self) -> Optional[int]:
+        """
+        Take the lease if it's free or renew own one, return the fencing token
+        when leading.
+        """
+        start = time.monotonic()
+        token = acquire_lease(
+            keys=[self.key, f"{self.key}_token"], args=[self.identity, self.ttl * 1000]
+        )
+        with self.lock:
+            self.token = token
+            self.valid_until = start + self.ttl if token else 0
+        LEADER_TOKEN.set(token or 0)
+        return token
+
+    def resign(self) -> None:
+        with self.lock:
+            token, self.token, self.valid_until = self.token, None, 0
+        if token:
+            release_lease(keys=[self.key], args=[self.identity, token])
+        LEADER_TOKEN.set(0)
+
+    def claim(self, key: str, ttl: int) -> bool:
+        """
+        Claim a run under own fencing token, fails once a newer leader took over.
+        """
+        token = self.token
+        if not token:
+            return False
+        return bool(claim_run(keys=[key, f"{self.key}_token"], args=[token, ttl]))
+
+    def start(self) -> None:
+        """
+        Keep campaigning in background, a leader renews its lease every third of
+        its TTL & the others take it over within a TTL after the leader is gone.
+        """
+        with self.lock:
+            if self.heartbeat is not None:
+                return
+            self.heartbeat = threading.Thread(target=self.run, daemon=True)
+        self.heartbeat.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.campaign()
+            except Exception:
+                self.token = None  # cant tell if still leading
+            time.sleep(self.ttl / 3)
+
+
+elector = LeaderElection(config.LEADER_KEY, config.LEADER_TTL)
+
+
+class LeaderHuey(RedisHuey):
+    """
+    Huey enqueueing periodic tasks only while leading. Each run is claimed once
+    more per minute, for the case of a new leader starting within the minute
+    the previous one enqueued the tasks in. Claims of a deposed leader are
+    rejected by its stale fencing token.
+    """
+
+    def read_periodic(self, timestamp):
+        timestamp = timestamp or self._get_timestamp()
+        tasks = super().read_periodic(timestamp)
+        if not tasks or not elector.campaign():
+            return []
+
+        minute = timestamp.strftime("%Y%m%d%H%M")
+        return [
+            task
+            for task in tasks
+            if elector.claim(f"{config.PERIODIC_PREFIX}{task.name}:{minute}", 120)
+        ]
+
+
+acquire_lease = client.register_script(ACQUIRE_LEASE)
+release_lease = client.register_script(RELEASE_LEASE)
+claim_run = client.register_script(CLAIM_RUN)
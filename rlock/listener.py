@@ -0,0 +1,39 @@
+from redis.exceptions import ResponseError
+
+from . import config
+from .tasker import check_channel
+
+client = config.get_redis()
+
+EXPIRED_EVENTS = "__keyevent@*__:expired"
+
+
+def enable_notifications():
+    """
+    Make Redis publish expired keys, unless it's managed & configured already.
+    """
+    try:
+        client.config_set("notify-keyspace-events", "Ex")
+    except ResponseError:
+        pass
+
+
+def handle_event(message: dict) -> bool:
+    key = message["data"].decode("utf-8")
+    if not key.startswith(config.SHADOW_PREFIX):
+        return False
+
+    check_channel(key[len(config.SHADOW_PREFIX) :])
+    return True
+
+
+def listen():
+    enable_notifications()
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe(EXPIRED_EVENTS)
+    for message in pubsub.listen():
+        handle_event(message)
+
+
+if __name__ == "__main__":
+    listen()
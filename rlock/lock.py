@@ -1,13 +1,27 @@
-from typing import Optional, Tuple
+import json
+from operator import attrgetter
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import arrow
 import attr
-from attr import asdict
+from redis.exceptions import ResponseError
 
 from . import config
+from .cache import MISSING, ReadCache
+from .metrics import observe_redis
+from .scripts import (
+    ACQUIRE_LOCK,
+    ACQUIRE_LOCKS,
+    HANDOFF_LOCK,
+    LOCK_CODEC,
+    MIGRATE_LOCK,
+    PATCH_LOCK,
+)
 
 client = config.get_redis()
 
+lock_cache = ReadCache("lock", config.CACHE_SIZE, config.CACHE_TTL)
+
 LOCK_FIELDS = [
     "user_id",
     "channel_id",
@@ -17,10 +31,41 @@ LOCK_FIELDS = [
     "message_id",
     "extra_msg",
     "init_tstamp",
+    "version",
+    "handoff",
+    "resource",
+    "mode",
 ]
+NUMERIC_FIELDS = [
+    "expiry_tstamp",
+    "user_notified",
+    "channel_notified",
+    "init_tstamp",
+    "version",
+    "handoff",
+]
+FORMAT_VERSION = 3  # of packed lock, bump when changing LOCK_FIELDS
+lock_values = attrgetter(*LOCK_FIELDS)
+
+LOCKED = "locked"
+EXTENDED = "extended"
+QUEUED = "queued"
+QUEUED_ALREADY = "queued_already"
 
+SHARED = "shared"  # joined a read lock, or left it to the other readers
 
-@attr.s
+RELEASED = "released"  # results of handoff_lock
+HANDED_OFF = "handed_off"
+SUPERSEDED = "superseded"
+
+READ = "read"  # lock shared by readers, exclusive is the default
+WRITE = "write"
+
+WARN = "warn"  # kinds of announcements about a lock
+EXPIRE = "expire"
+
+
+@attr.s(slots=True)
 class Lock:
     user_id: str = attr.ib()
     channel_id: str = attr.ib()
@@ -30,6 +75,10 @@ class Lock:
     channel_notified: int = attr.ib(default=0)
     message_id: Optional[str] = attr.ib(default=None)
     extra_msg: Optional[str] = attr.ib(default=None)
+    version: int = attr.ib(default=0)  # changes with every set/extend of the lock
+    handoff: int = attr.ib(default=0)  # handed off from queue, not taken over yet
+    resource: Optional[str] = attr.ib(default=None)  # named lock within the channel
+    mode: Optional[str] = attr.ib(default=None)  # READ, exclusive otherwise
 
     @property
     def remaining(self) -> int:
@@ -41,99 +90,486 @@ class Lock:
 
     @property
     def is_expiring(self):
-        return self.expiry_tstamp < (arrow.now().timestamp + config.EXPIRY_WARN * 60)
+        return self.warn_tstamp < arrow.now().timestamp
+
+    @property
+    def warn_tstamp(self) -> int:
+        return self.expiry_tstamp - config.EXPIRY_WARN * 60
+
+    @property
+    def lock_id(self) -> str:
+        return make_lock_id(self.channel_id, self.resource)
 
     @property
     def full_id(self):
-        return f"{config.CHANNEL_PREFIX}{self.channel_id}"
+        return f"{config.CHANNEL_PREFIX}{self.lock_id}"
+
+    @property
+    def shadow_id(self):
+        return f"{config.SHADOW_PREFIX}{self.lock_id}"
 
     @property
     def ping_id(self):
-        return f"{config.PING_PREFIX}{self.channel_id}"
+        return f"{config.PING_PREFIX}{self.lock_id}"
+
+    @property
+    def readers_id(self):
+        return f"{config.READERS_PREFIX}{self.lock_id}"
+
+    @property
+    def label(self) -> str:
+        return f"*{self.resource}* " if self.resource else ""
 
     @property
     def duration(self):
         return int((self.expiry_tstamp - self.init_tstamp) / 60)
 
+    @observe_redis
     def set_message_id(self, message_id: str):
         self.message_id = message_id
-        client.hset(self.full_id, "message_id", message_id)
-
-    def get_subscribers(self, destructive: bool = False) -> list:
-        if not destructive:
+        pipe = client.pipeline()
+        patch_script(keys=[self.full_id], args=["message_id", message_id], client=pipe)
+        lock_cache.invalidate(self.full_id, pipe)
+        pipe.execute()
+
+    @observe_redis
+    def get_subscribers(self) -> list:
+        """
+        Return users waiting for the lock, in the order they queued up in.
+        """
+        try:
+            users = client.zrange(self.ping_id, 0, -1)
+        except ResponseError:  # unordered set of previous version
             users = client.smembers(self.ping_id)
-            return ["`<@{}>`".format(x.decode("utf-8")) for x in users]
-
-        users = []
-        while 1:
-            new: bytes = client.spop(self.ping_id)
-            if not new:
-                break
-            users.append(new)
-
-        return ["<@{}>".format(x.decode("utf-8")) for x in users]
-
-    def get_unlock_message(self, extra_msg: str = ""):
-        subscribers = self.get_subscribers(destructive=True)
-        slack_str = "" if not subscribers else " ".join(["\ncc"] + subscribers)
-        return f"🔓 _unlock_ {extra_msg} {slack_str}"
+        return ["`<@{}>`".format(x.decode("utf-8")) for x in users]
+
+    @observe_redis
+    def get_readers(self) -> List[str]:
+        if self.mode != READ:
+            return [self.user_id]
+        readers = sorted(x.decode("utf-8") for x in client.smembers(self.readers_id))
+        return readers or [self.user_id]
+
+    def is_holder(self, user_id: str) -> bool:
+        return user_id == self.user_id or user_id in self.get_readers()
+
+    def get_unlock_message(
+        self, extra_msg: str = "", next_lock: Optional["Lock"] = None
+    ):
+        if not next_lock:
+            return f"🔓 _unlock_ {self.label}{extra_msg}"
+
+        return (
+            f"🔓 _unlock_ {self.label}{extra_msg}\n<@{next_lock.user_id}>, it's your "
+            f"turn, `/rlock {self.resource or ''}` within {config.HANDOFF_WINDOW} "
+            "mins to take over the lock"
+        )
 
     def get_lock_message(self) -> str:
-        slack_str = (
-            ""
-            if not self.get_subscribers()
-            else " ".join(["\nQ:"] + self.get_subscribers())
-        )
-        return f'{config.LOCK_ICONS[self.user_id]} _LOCK_ {self.extra_msg or ""} (`<@{self.user_id}>`, {self.duration} mins) {slack_str}'
+        subscribers = self.get_subscribers()
+        slack_str = "" if not subscribers else " ".join(["\nQ:"] + subscribers)
+        holders = " ".join(f"`<@{x}>`" for x in self.get_readers())
+        if self.mode == READ:
+            holders = f"{READ}: {holders}"
+        return f'{config.LOCK_ICONS[self.user_id]} _LOCK_ {self.label}{self.extra_msg or ""} ({holders}, {self.duration} mins) {slack_str}'
 
     def update_lock_message(self, unlock: bool = False) -> Tuple[bool, Optional[str]]:
         from .slackbot import update_channel_message
 
+        if not self.message_id:  # handed off, not announced yet
+            return False, None
         return update_channel_message(self, self.get_lock_message(), unlock=unlock)
 
-    def add_new_subscriber(self, ping_user: str) -> int:
-        new_sub = client.sadd(self.ping_id, ping_user)
-        if new_sub:
-            self.update_lock_message()
 
-        return new_sub
+def make_lock_id(channel_id: str, resource: Optional[str] = None) -> str:
+    """
+    Id of the lock of a channel, or of a named resource in the channel.
+    """
+    return f"{channel_id}:{resource}" if resource else channel_id
+
+
+def split_lock_id(lock_id: str) -> Tuple[str, Optional[str]]:
+    channel_id, _, resource = lock_id.partition(":")
+    return channel_id, resource or None
 
 
+@observe_redis
 def get_lock(channel_id: str, has_prefix: bool = False) -> Optional[Lock]:
     """
-    Check & return owner of a lock in channel.
+    Check & return owner of a lock in channel, `channel_id` can be a lock id of
+    a resource in the channel as well.
     """
     key_name = channel_id if has_prefix else f"{config.CHANNEL_PREFIX}{channel_id}"
-    vals = client.hmget(key_name, LOCK_FIELDS)
-    if not any(vals):
+    if isinstance(key_name, bytes):
+        key_name = key_name.decode("utf-8")
+
+    lock = lock_cache.get(key_name)
+    if lock is not MISSING:
+        return lock
+
+    token = lock_cache.token()
+    try:
+        packed = client.get(key_name)
+    except ResponseError:  # stored as hash by previous version
+        packed = migrate_script(keys=[key_name])
+
+    lock = decode_lock(packed)
+    lock_cache.set(key_name, lock, token)
+    return lock
+
+
+@observe_redis
+def get_locks(channel_ids: Iterable[str], has_prefix: bool = False) -> Dict[str, Lock]:
+    """
+    Return existing locks of given channels, fetched in a single round trip.
+    """
+    channel_ids = list(channel_ids)
+    key_names = [
+        channel_id if has_prefix else f"{config.CHANNEL_PREFIX}{channel_id}"
+        for channel_id in channel_ids
+    ]
+    pipe = client.pipeline(transaction=False)
+    for key_name in key_names:
+        pipe.get(key_name)
+
+    locks = {}
+    results = pipe.execute(raise_on_error=False)
+    for channel_id, key_name, packed in zip(channel_ids, key_names, results):
+        if isinstance(packed, ResponseError):  # stored as hash by previous version
+            packed = migrate_script(keys=[key_name])
+
+        lock = decode_lock(packed)
+        if lock:
+            locks[channel_id] = lock
+
+    return locks
+
+
+def encode_lock(lock: Lock) -> str:
+    return json.dumps((FORMAT_VERSION,) + lock_values(lock), separators=(",", ":"))
+
+
+def decode_lock(packed: Optional[bytes]) -> Optional[Lock]:
+    if not packed:
         return None
 
-    values = dict(zip(LOCK_FIELDS, vals))
-    lock = Lock(
-        user_id=values["user_id"] and values["user_id"].decode("utf-8"),
-        channel_id=values["channel_id"] and values["channel_id"].decode("utf-8"),
-        expiry_tstamp=int(values["expiry_tstamp"]),
-        init_tstamp=int(values.get("init_tstamp") or arrow.now().timestamp),
-        user_notified=int(values["user_notified"] or 0),
-        channel_notified=int(values["channel_notified"] or 0),
-        message_id=values.get("message_id") and values["message_id"].decode("utf-8"),
-        extra_msg=values.get("extra_msg") and values["extra_msg"].decode("utf-8"),
-    )
+    values = json.loads(packed)
+    # newer formats only append fields, the missing ones get their defaults
+    lock = Lock(**dict(zip(LOCK_FIELDS, values[1:])))
 
-    if lock.is_expired and lock.channel_notified:
+    if lock.channel_notified and lock.is_expired:
         # lock expired & announced, should be gone
         return None
 
     return lock
 
 
+@observe_redis
 def set_lock(lock: Lock) -> bool:
-    return client.hmset(lock.full_id, asdict(lock))
+    pipe = client.pipeline()
+    pipe.set(lock.full_id, encode_lock(lock))
+    index_lock(lock, pipe)
+    expire_lock(lock, pipe)
+    lock_cache.invalidate(lock.full_id, pipe)
+    return pipe.execute()[0]
+
 
+def expire_lock(lock: Lock, pipe):
+    """
+    Let Redis drop the lock data on its own & announce the expiration via
+    keyspace notification of the shadow key.
+    """
+    pipe.expireat(lock.full_id, lock.expiry_tstamp + config.LOCK_GRACE)
+    pipe.expireat(lock.ping_id, lock.expiry_tstamp + config.LOCK_GRACE)
+    pipe.expireat(lock.readers_id, lock.expiry_tstamp + config.LOCK_GRACE)
+    pipe.set(lock.shadow_id, 1)
+    pipe.expireat(lock.shadow_id, lock.expiry_tstamp + 1)
+
+
+def index_lock(lock: Lock, pipe):
+    """
+    Keep the lock in the expiry index so the tasker doesnt have to scan all locks.
+    """
+    pipe.zadd(config.EXPIRY_INDEX, lock.expiry_tstamp, lock.lock_id)
+    if lock.user_notified:
+        pipe.zrem(config.WARN_INDEX, lock.lock_id)
+    else:
+        pipe.zadd(config.WARN_INDEX, lock.warn_tstamp, lock.lock_id)
 
+
+@observe_redis
+def acquire_lock(lock: Lock, lock_time: int = 30) -> str:
+    """
+    Set a new lock, extend own lock by `lock_time` minutes, join a read lock, or
+    subscribe to a lock owned by someone else. The lock is updated to the stored
+    state, its owner is the first reader of a read lock.
+    """
+    from .channel_stats import active_key, stats_expiry, stats_key
+
+    now = arrow.now().timestamp
+    res = acquire_script(
+        keys=[
+            lock.full_id,
+            lock.ping_id,
+            stats_key(lock.channel_id, now),
+            config.EXPIRY_INDEX,
+            config.WARN_INDEX,
+            config.LOCK_VERSION,
+            lock.shadow_id,
+            active_key(now),
+            lock.readers_id,
+        ],
+        args=[
+            lock.user_id,
+            lock.channel_id,
+            lock.expiry_tstamp,
+            lock.init_tstamp,
+            lock.extra_msg or "",
+            now,
+            lock_time * 60,
+            config.EXPIRY_WARN * 60,
+            stats_expiry(now),
+            config.LOCK_GRACE,
+            lock.lock_id,
+            lock.resource or "",
+            lock.mode or "",
+            config.CACHE_CHANNEL,
+            lock_cache.invalidation(lock.full_id),
+        ],
+    )
+    status = res[0].decode("utf-8")
+    if status in (LOCKED, EXTENDED, SHARED):
+        lock_cache.evict(lock.full_id)
+        stored = decode_lock(res[1])
+        for field in LOCK_FIELDS:
+            setattr(lock, field, getattr(stored, field))
+
+    return status
+
+
+@observe_redis
+def acquire_locks(locks: List[Lock]) -> Tuple[bool, Dict[str, str]]:
+    """
+    Set or extend locks of a single user all at once, or none of them when any
+    is held by someone else. Return the statuses by lock id, or the users who
+    hold the blocking locks. The locks are updated to the stored state.
+    """
+    from .channel_stats import active_key, stats_expiry, stats_key
+
+    user_id, expiry = locks[0].user_id, locks[0].expiry_tstamp
+    extra_msg = locks[0].extra_msg or ""
+    locks = sorted({x.lock_id: x for x in locks}.values(), key=attrgetter("full_id"))
+    if any(x.user_id != user_id for x in locks):
+        raise ValueError("locks of more users")
+
+    now = arrow.now().timestamp
+    keys = [
+        config.EXPIRY_INDEX,
+        config.WARN_INDEX,
+        config.LOCK_VERSION,
+        active_key(now),
+    ]
+    args = [
+        user_id,
+        now,
+        expiry,
+        extra_msg,
+        config.EXPIRY_WARN * 60,
+        stats_expiry(now),
+        config.LOCK_GRACE,
+        config.CACHE_CHANNEL,
+        lock_cache.invalidation(*[x.full_id for x in locks]),
+    ]
+    for lock in locks:
+        keys += [
+            lock.full_id,
+            lock.ping_id,
+            lock.shadow_id,
+            stats_key(lock.channel_id, now),
+            lock.readers_id,
+        ]
+        args += [lock.channel_id, lock.lock_id, lock.resource or ""]
+
+    res = acquire_many_script(keys=keys, args=args)
+    if res[0] != b"locked":
+        blocked = iter(x.decode("utf-8") for x in res[1:])
+        return False, dict(zip(blocked, blocked))
+
+    statuses = {}
+    for lock, status, packed in zip(locks, res[1::2], res[2::2]):
+        lock_cache.evict(lock.full_id)
+        stored = decode_lock(packed)
+        for field in LOCK_FIELDS:
+            setattr(lock, field, getattr(stored, field))
+        statuses[lock.lock_id] = status.decode("utf-8")
+
+    return True, statuses
+
+
+@observe_redis
 def remove_lock(lock: Lock):
-    client.hdel(lock.full_id, *LOCK_FIELDS)
+    pipe = client.pipeline()
+    pipe.delete(lock.full_id, lock.shadow_id, lock.readers_id)
+    lock_cache.invalidate(lock.full_id, pipe)
+    pipe.zrem(config.EXPIRY_INDEX, lock.lock_id)
+    pipe.zrem(config.WARN_INDEX, lock.lock_id)
+    pipe.execute()
+
+
+@observe_redis
+def handoff_lock(lock: Lock, user_id: str = "") -> Tuple[str, Optional[Lock]]:
+    """
+    End the lock & hand it off to the first one in queue in one atomic step,
+    instead of pinging everyone waiting to race for it. Return the new lock, or
+    none when nobody waits or the lock was changed meanwhile. A reader given by
+    `user_id` leaves a read lock to the other readers, if there are any left.
+    """
+    res = handoff_script(
+        keys=[
+            lock.full_id,
+            lock.ping_id,
+            config.EXPIRY_INDEX,
+            config.WARN_INDEX,
+            config.LOCK_VERSION,
+            lock.shadow_id,
+            lock.readers_id,
+        ],
+        args=[
+            lock.channel_id,
+            lock.version,
+            arrow.now().timestamp,
+            config.HANDOFF_WINDOW * 60,
+            config.LOCK_GRACE,
+            lock.lock_id,
+            lock.resource or "",
+            user_id,
+            config.CACHE_CHANNEL,
+            lock_cache.invalidation(lock.full_id),
+        ],
+    )
+    lock_cache.evict(lock.full_id)
+    status = res[0].decode("utf-8")
+    return status, decode_lock(res[1]) if status in (HANDED_OFF, SHARED) else None
 
 
+def refresh_key(lock_id: str) -> str:
+    return f"{config.REFRESH_PREFIX}{lock_id}"
+
+
+@observe_redis
+def claim_refresh(lock_id: str) -> bool:
+    """
+    Plan an update of the lock message unless one is planned already.
+    """
+    expire = int((config.REFRESH_DELAY + 60) * 1000)  # in case the update gets lost
+    return bool(client.set(refresh_key(lock_id), 1, nx=True, px=expire))
+
+
+@observe_redis
+def release_refresh(lock_id: str):
+    client.delete(refresh_key(lock_id))
+
+
+def extension_key(lock_id: str) -> str:
+    return f"{config.EXTENSION_PREFIX}{lock_id}"
+
+
+@observe_redis
+def add_extension(lock_id: str, minutes: int) -> bool:
+    """
+    Add up minutes of extensions to announce, return whether it's the first one.
+    """
+    key_name = extension_key(lock_id)
+    pipe = client.pipeline()
+    pipe.incrby(key_name, minutes)
+    pipe.expire(key_name, config.EXTEND_MERGE + 60)  # in case the post gets lost
+    return pipe.execute()[0] == minutes
+
+
+@observe_redis
+def pop_extensions(lock_id: str) -> int:
+    key_name = extension_key(lock_id)
+    pipe = client.pipeline()
+    pipe.get(key_name)
+    pipe.delete(key_name)
+    return int(pipe.execute()[0] or 0)
+
+
+@observe_redis
 def mark_user_notified(lock: Lock):
-    client.hset(lock.full_id, "user_notified", 1)
+    pipe = client.pipeline()
+    patch_script(keys=[lock.full_id], args=["user_notified", 1], client=pipe)
+    pipe.zrem(config.WARN_INDEX, lock.lock_id)
+    lock_cache.invalidate(lock.full_id, pipe)
+    pipe.execute()
+
+
+def announcement_key(lock: Lock, kind: str) -> str:
+    return f"{config.ANNOUNCE_PREFIX}{lock.lock_id}:{lock.init_tstamp}:{lock.version}:{kind}"
+
+
+@observe_redis
+def claim_announcement(lock: Lock, kind: str) -> bool:
+    """
+    Make sure just one worker announces expiry or warning of the lock.
+    """
+    key_name = announcement_key(lock, kind)
+    return bool(client.set(key_name, 1, nx=True, ex=config.LOCK_GRACE))
+
+
+@observe_redis
+def release_announcement(lock: Lock, kind: str):
+    client.delete(announcement_key(lock, kind))
+
+
+@observe_redis
+def get_due_channels(until: Optional[int] = None) -> List[str]:
+    """
+    Return ids of locks to expire or to warn about until given timestamp.
+    """
+    until = until or arrow.now().timestamp
+    pipe = client.pipeline(transaction=False)
+    pipe.zrangebyscore(config.EXPIRY_INDEX, "-inf", until)
+    pipe.zrangebyscore(config.WARN_INDEX, "-inf", until)
+    expiring, warning = pipe.execute()
+    return sorted({x.decode("utf-8") for x in expiring + warning})
+
+
+@observe_redis
+def remove_from_index(lock_id: str):
+    """
+    Drop index entries of a lock which doesnt exist anymore.
+    """
+    pipe = client.pipeline()
+    pipe.zrem(config.EXPIRY_INDEX, lock_id)
+    pipe.zrem(config.WARN_INDEX, lock_id)
+    pipe.execute()
+
+
+@observe_redis
+def index_locks():
+    """
+    Add locks stored before the expiry index & TTLs existed into the index.
+    """
+    keys = client.scan_iter(f"{config.CHANNEL_PREFIX}*")
+    pipe = client.pipeline(transaction=False)
+    for lock in get_locks(keys, has_prefix=True).values():
+        index_lock(lock, pipe)
+        expire_lock(lock, pipe)
+    pipe.execute()
+
+
+def lock_script(source: str):
+    codec = LOCK_CODEC.substitute(
+        format=FORMAT_VERSION,
+        fields=", ".join(f'"{field}"' for field in LOCK_FIELDS),
+        numeric=", ".join(f"{field} = true" for field in NUMERIC_FIELDS),
+    )
+    return client.register_script(codec + source)
+
+
+acquire_script = lock_script(ACQUIRE_LOCK)
+acquire_many_script = lock_script(ACQUIRE_LOCKS)
+handoff_script = lock_script(HANDOFF_LOCK)
+migrate_script = lock_script(MIGRATE_LOCK)
+patch_script = lock_script(PATCH_LOCK)
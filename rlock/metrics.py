@@ -0,0 +1,96 @@
+"""
+Prometheus metrics of the webserver & the tasker, exported on /metrics.
+"""
+from functools import wraps
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+from .cache import get_cache_stats
+from .tracing import span
+
+REQUEST_SECONDS = Histogram(
+    "rlock_request_seconds", "Duration of HTTP requests", ["path", "status"]
+)
+REDIS_SECONDS = Histogram(
+    "rlock_redis_seconds", "Duration of Redis operations", ["method", "outcome"]
+)
+SLACK_SECONDS = Histogram(
+    "rlock_slack_seconds", "Duration of Slack API calls", ["method", "outcome"]
+)
+SLACK_WAIT_SECONDS = Histogram(
+    "rlock_slack_wait_seconds", "Time Slack calls waited for rate limits", ["method"]
+)
+SWEEP_SECONDS = Histogram(
+    "rlock_sweep_seconds",
+    "Duration of expiry sweeps of the tasker",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+SWEEP_LOCKS = Counter(
+    "rlock_sweep_locks", "Channels due in expiry sweeps", ["result"]
+)  # scanned, acted, orphaned
+TASK_LAG_SECONDS = Histogram(
+    "rlock_task_lag_seconds",
+    "Delay between planned & actual start of tasks",
+    ["task"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300),
+)
+DUPLICATE_REQUESTS = Counter(
+    "rlock_duplicate_requests", "Retried requests answered from cache", ["endpoint"]
+)
+QUEUE_PENDING = Gauge("rlock_queue_pending", "Tasks waiting in the queue")
+LEADER_TOKEN = Gauge(
+    "rlock_leader_token", "Fencing token of the lease held by the tasker, 0 if none"
+)
+
+
+def observe_redis(func):
+    """
+    Measure duration & outcome of a function talking to Redis.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            with span(f"redis.{func.__name__}"):
+                result = func(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            REDIS_SECONDS.labels(func.__name__, outcome).observe(
+                time.perf_counter() - start
+            )
+
+    return wrapper
+
+
+def slack_outcome(res: dict) -> str:
+    if res.get("ok"):
+        return "ok"
+    elif res.get("error") == "ratelimited":
+        return "ratelimited"
+    return "error"
+
+
+class CacheCollector:
+    """
+    Export hit/miss counters of the in-process caches.
+    """
+
+    def collect(self):
+        hits = CounterMetricFamily("rlock_cache_hits", "Cache hits", labels=["cache"])
+        misses = CounterMetricFamily(
+            "rlock_cache_misses", "Cache misses", labels=["cache"]
+        )
+        size = GaugeMetricFamily("rlock_cache_size", "Cached items", labels=["cache"])
+        for name, stats in get_cache_stats().items():
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            size.add_metric([name], stats["size"])
+        return [hits, misses, size]
+
+
+REGISTRY.register(CacheCollector())
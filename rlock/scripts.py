@@ -0,0 +1,460 @@
+"""
+Lua scripts run by Redis, so multi-step changes of locks are atomic.
+"""
+from string import Template
+
+# Decoding & encoding of a lock stored as JSON array [format, *LOCK_FIELDS],
+# or as a hash by the previous versions, and of its wait queue.
+# Placeholders are filled in by lock.py.
+LOCK_CODEC = Template(
+    """
+local FORMAT = $format
+local FIELDS = {$fields}
+local NUMERIC = {$numeric}
+
+local function load_lock(key)
+    local kind = redis.call("TYPE", key).ok
+    local lock = {}
+    if kind == "string" then
+        local packed = cjson.decode(redis.call("GET", key))
+        for i, name in ipairs(FIELDS) do
+            if packed[i + 1] ~= cjson.null then
+                lock[name] = packed[i + 1]
+            end
+        end
+    elseif kind == "hash" then
+        local values = redis.call("HMGET", key, unpack(FIELDS))
+        for i, name in ipairs(FIELDS) do
+            local value = values[i]
+            if value and value ~= "None" then
+                lock[name] = NUMERIC[name] and tonumber(value) or value
+            end
+        end
+    else
+        return nil
+    end
+    return lock
+end
+
+local function store_lock(key, lock, expire_at)
+    local packed = {FORMAT}
+    for i, name in ipairs(FIELDS) do
+        local value = lock[name]
+        if value == nil then
+            value = NUMERIC[name] and 0 or cjson.null
+        end
+        packed[i + 1] = value
+    end
+
+    local ttl = redis.call("PTTL", key)
+    redis.call("SET", key, cjson.encode(packed))
+    if expire_at then
+        redis.call("EXPIREAT", key, expire_at)
+    elseif ttl > 0 then
+        redis.call("PEXPIRE", key, ttl)
+    end
+end
+
+-- store a set or extended lock with its index entries, shadow key & stats
+-- keys: lock, queue, readers, shadow, stats, active, expiry_index, warn_index
+local function save_lock(keys, lock, lock_id, now, warn, grace, stats_expiry, counter)
+    local expiry = lock.expiry_tstamp
+    store_lock(keys.lock, lock, expiry + grace)
+    redis.call("ZADD", keys.expiry_index, expiry, lock_id)
+    if lock.user_notified == 1 then
+        redis.call("ZREM", keys.warn_index, lock_id)
+    else
+        redis.call("ZADD", keys.warn_index, expiry - warn, lock_id)
+    end
+    redis.call("EXPIREAT", keys.queue, expiry + grace)
+    redis.call("EXPIREAT", keys.readers, expiry + grace)
+    redis.call("SET", keys.shadow, 1)
+    redis.call("EXPIREAT", keys.shadow, expiry + 1)
+
+    redis.call("HSETNX", keys.stats, "channel_id", lock.channel_id)
+    redis.call("HSETNX", keys.stats, "created_tstamp", now)
+    redis.call("HINCRBY", keys.stats, counter, 1)
+    redis.call("EXPIREAT", keys.stats, stats_expiry)
+    redis.call("SADD", keys.active, lock.channel_id)
+    redis.call("EXPIREAT", keys.active, stats_expiry)
+end
+
+-- queue is a sorted set of user -> time of queueing up, previous versions
+-- kept an unordered set, its users are queued up as of now
+local function load_queue(key, now)
+    if redis.call("TYPE", key).ok ~= "set" then
+        return
+    end
+
+    local users = redis.call("SMEMBERS", key)
+    local ttl = redis.call("PTTL", key)
+    redis.call("DEL", key)
+    for _, user in ipairs(users) do
+        redis.call("ZADD", key, now, user)
+    end
+    if ttl > 0 then
+        redis.call("PEXPIRE", key, ttl)
+    end
+end
+
+local function queue_up(key, user, now, expire_at)
+    if redis.call("ZSCORE", key, user) then
+        return false
+    end
+
+    -- keep the order of users queued up within the same second
+    local last = redis.call("ZRANGE", key, -1, -1, "WITHSCORES")
+    local score = now
+    if last[2] and tonumber(last[2]) >= now then
+        score = tonumber(last[2]) + 0.001
+    end
+    redis.call("ZADD", key, score, user)
+    redis.call("EXPIREAT", key, expire_at)
+    return true
+end
+
+-- drop cached copies of changed locks in app processes, none when not cached
+local function publish_invalidation(channel, message)
+    if message ~= "" then
+        redis.call("PUBLISH", channel, message)
+    end
+end
+"""
+)
+
+# set/extend a lock, join a read lock or queue up for it, all in one atomic step
+# KEYS: lock, wait queue, today channel stats, expiry index, warn index,
+#       version counter, shadow key, today active channels, readers
+# ARGV: user, channel, expiry, init tstamp, extra msg, now, extension (s), warn (s),
+#       expiry of today stats, grace (s), lock id, resource, mode, cache channel,
+#       cache invalidation
+ACQUIRE_LOCK = """
+local user_id, channel_id = ARGV[1], ARGV[2]
+local expiry, init_tstamp, extra_msg = tonumber(ARGV[3]), tonumber(ARGV[4]), ARGV[5]
+local now, extension = tonumber(ARGV[6]), tonumber(ARGV[7])
+local warn, stats_expiry = tonumber(ARGV[8]), tonumber(ARGV[9])
+local grace = tonumber(ARGV[10])
+local lock_id, resource, mode = ARGV[11], ARGV[12], ARGV[13]
+local cache_channel, invalidation = ARGV[14], ARGV[15]
+
+load_queue(KEYS[2], now)
+local current = load_lock(KEYS[1])
+local status, message_id, owner, notified = "locked", nil, user_id, 0
+if current and current.expiry_tstamp >= now then
+    local shared = current.mode == "read"
+    if current.user_id ~= user_id
+        and not (shared and redis.call("SISMEMBER", KEYS[9], user_id) == 1) then
+        -- readers share the lock, unless someone waits for it already
+        if not (shared and mode == "read" and redis.call("ZCARD", KEYS[2]) == 0) then
+            local expire_at = current.expiry_tstamp + grace
+            return {queue_up(KEYS[2], user_id, now, expire_at) and "queued" or "queued_already"}
+        end
+
+        status = "shared"
+        if current.expiry_tstamp >= expiry then
+            expiry = current.expiry_tstamp
+            notified = current.user_notified or 0
+        end
+    elseif current.handoff ~= 1 then
+        -- taking over a lock handed off from the queue is a new lock
+        status = "extended"
+        expiry = current.expiry_tstamp + extension
+    end
+
+    if status ~= "locked" then
+        owner = current.user_id
+        mode = current.mode or ""
+        init_tstamp = current.init_tstamp or init_tstamp
+        extra_msg = current.extra_msg or ""
+        message_id = current.message_id
+    end
+elseif current then
+    -- expired & about to be handed off, dont let anyone jump the queue
+    local head = redis.call("ZRANGE", KEYS[2], 0, 0)[1]
+    if head and head ~= user_id then
+        local expire_at = now + grace
+        return {queue_up(KEYS[2], user_id, now, expire_at) and "queued" or "queued_already"}
+    end
+end
+redis.call("ZREM", KEYS[2], user_id)
+publish_invalidation(cache_channel, invalidation)
+
+if status == "locked" then
+    redis.call("DEL", KEYS[9])
+end
+if mode == "read" and status ~= "extended" then
+    redis.call("SADD", KEYS[9], user_id)
+end
+
+local keys = {
+    lock = KEYS[1],
+    queue = KEYS[2],
+    stats = KEYS[3],
+    expiry_index = KEYS[4],
+    warn_index = KEYS[5],
+    shadow = KEYS[7],
+    active = KEYS[8],
+    readers = KEYS[9],
+}
+save_lock(keys, {
+    user_id = owner,
+    channel_id = channel_id,
+    expiry_tstamp = expiry,
+    init_tstamp = init_tstamp,
+    user_notified = notified,
+    channel_notified = 0,
+    message_id = message_id,
+    extra_msg = extra_msg,
+    version = redis.call("INCR", KEYS[6]),
+    resource = resource ~= "" and resource or nil,
+    mode = mode == "read" and mode or nil,
+}, lock_id, now, warn, grace, stats_expiry,
+    status == "extended" and "extends_count" or "locks_count")
+
+return {status, redis.call("GET", KEYS[1])}
+"""
+
+# set or extend several locks of a user at once, or none of them when any is
+# held by someone else, so a pipeline never holds just a part of them
+# KEYS: expiry index, warn index, version counter, today active channels,
+#       then per lock: lock, wait queue, shadow key, today channel stats, readers
+# ARGV: user, now, expiry, extra msg, warn (s), expiry of today stats, grace (s),
+#       cache channel, cache invalidation, then per lock: channel, lock id, resource
+ACQUIRE_LOCKS = """
+local user_id, now, expiry = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local extra_msg, warn = ARGV[4], tonumber(ARGV[5])
+local stats_expiry, grace = tonumber(ARGV[6]), tonumber(ARGV[7])
+local cache_channel, invalidation = ARGV[8], ARGV[9]
+
+local function lock_keys(i)
+    local base = 4 + (i - 1) * 5
+    return {
+        lock = KEYS[base + 1],
+        queue = KEYS[base + 2],
+        shadow = KEYS[base + 3],
+        stats = KEYS[base + 4],
+        readers = KEYS[base + 5],
+        expiry_index = KEYS[1],
+        warn_index = KEYS[2],
+        active = KEYS[4],
+    }
+end
+
+local count = (#KEYS - 4) / 5
+local blocked, current = {}, {}
+for i = 1, count do
+    local keys, lock_id = lock_keys(i), ARGV[9 + (i - 1) * 3 + 2]
+    load_queue(keys.queue, now)
+    local lock = load_lock(keys.lock)
+    local holder = nil
+    if lock and lock.expiry_tstamp >= now then
+        if lock.user_id ~= user_id then
+            holder = lock.user_id
+        elseif lock.mode == "read" and redis.call("SCARD", keys.readers) > 1 then
+            -- shared with other readers, report one of them
+            local readers = redis.call("SMEMBERS", keys.readers)
+            table.sort(readers)
+            for _, reader in ipairs(readers) do
+                if reader ~= user_id then
+                    holder = reader
+                    break
+                end
+            end
+        elseif lock.handoff ~= 1 then
+            -- taking over a lock handed off from the queue is a new lock
+            current[i] = lock
+        end
+    elseif lock then
+        -- expired & about to be handed off to the first one in queue
+        local head = redis.call("ZRANGE", keys.queue, 0, 0)[1]
+        if head and head ~= user_id then
+            holder = head
+        end
+    end
+    if holder then
+        table.insert(blocked, lock_id)
+        table.insert(blocked, holder)
+    end
+end
+
+if #blocked > 0 then
+    return {"blocked", unpack(blocked)}
+end
+publish_invalidation(cache_channel, invalidation)
+
+local res = {"locked"}
+for i = 1, count do
+    local keys, args = lock_keys(i), 9 + (i - 1) * 3
+    local channel_id, lock_id, resource = ARGV[args + 1], ARGV[args + 2], ARGV[args + 3]
+    local lock = current[i]
+    local status = lock and "extended" or "locked"
+    redis.call("ZREM", keys.queue, user_id)
+    redis.call("DEL", keys.readers)
+    save_lock(keys, {
+        user_id = user_id,
+        channel_id = channel_id,
+        expiry_tstamp = lock and math.max(lock.expiry_tstamp, expiry) or expiry,
+        init_tstamp = lock and lock.init_tstamp or now,
+        user_notified = 0,
+        channel_notified = 0,
+        message_id = lock and lock.message_id or nil,
+        extra_msg = lock and lock.extra_msg or extra_msg,
+        version = redis.call("INCR", KEYS[3]),
+        resource = resource ~= "" and resource or nil,
+    }, lock_id, now, warn, grace, stats_expiry,
+        status == "extended" and "extends_count" or "locks_count")
+    table.insert(res, status)
+    table.insert(res, redis.call("GET", keys.lock))
+end
+return res
+"""
+
+# end the lock & hand it off to the first one in queue, who has a claim window
+# to take it over before it's handed off to the next one. A reader leaving a read
+# lock ends it only when there are no other readers left.
+# KEYS: lock, wait queue, expiry index, warn index, version counter, shadow key,
+#       readers
+# ARGV: channel, version of the ended lock, now, claim window (s), grace (s),
+#       lock id, resource, leaving reader (none ends the lock for all),
+#       cache channel, cache invalidation
+HANDOFF_LOCK = """
+local channel_id, version = ARGV[1], tonumber(ARGV[2])
+local now, window, grace = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local lock_id, resource, reader = ARGV[6], ARGV[7], ARGV[8]
+local cache_channel, invalidation = ARGV[9], ARGV[10]
+
+local current = load_lock(KEYS[1])
+if current and (current.version or 0) ~= version then
+    return {"superseded"}
+end
+publish_invalidation(cache_channel, invalidation)
+
+if current and current.mode == "read" and reader ~= "" then
+    redis.call("SREM", KEYS[7], reader)
+    local other = redis.call("SRANDMEMBER", KEYS[7])
+    if other then
+        if current.user_id == reader then
+            current.user_id = other
+        end
+        current.version = redis.call("INCR", KEYS[5])
+        store_lock(KEYS[1], current)
+        return {"shared", redis.call("GET", KEYS[1])}
+    end
+end
+redis.call("DEL", KEYS[7])
+
+load_queue(KEYS[2], now)
+local user_id = redis.call("ZRANGE", KEYS[2], 0, 0)[1]
+if not user_id then
+    redis.call("DEL", KEYS[1], KEYS[2], KEYS[6])
+    redis.call("ZREM", KEYS[3], lock_id)
+    redis.call("ZREM", KEYS[4], lock_id)
+    return {"released"}
+end
+
+local expiry = now + window
+redis.call("ZREM", KEYS[2], user_id)
+store_lock(KEYS[1], {
+    user_id = user_id,
+    channel_id = channel_id,
+    expiry_tstamp = expiry,
+    init_tstamp = now,
+    user_notified = 1,  -- too short to warn about
+    channel_notified = 0,
+    version = redis.call("INCR", KEYS[5]),
+    handoff = 1,
+    resource = resource ~= "" and resource or nil,
+}, expiry + grace)
+redis.call("ZADD", KEYS[3], expiry, lock_id)
+redis.call("ZREM", KEYS[4], lock_id)
+redis.call("EXPIREAT", KEYS[2], expiry + grace)
+redis.call("SET", KEYS[6], 1)
+redis.call("EXPIREAT", KEYS[6], expiry + 1)
+
+return {"handed_off", redis.call("GET", KEYS[1])}
+"""
+
+# rewrite lock stored as hash into the packed format
+# KEYS: lock
+MIGRATE_LOCK = """
+if redis.call("TYPE", KEYS[1]).ok ~= "hash" then
+    return redis.call("GET", KEYS[1])
+end
+
+store_lock(KEYS[1], load_lock(KEYS[1]))
+return redis.call("GET", KEYS[1])
+"""
+
+# change some fields of an existing lock, keeping its TTL
+# KEYS: lock
+# ARGV: field, value, field, value...
+PATCH_LOCK = """
+local lock = load_lock(KEYS[1])
+if not lock then
+    return 0
+end
+
+for i = 1, #ARGV, 2 do
+    local name, value = ARGV[i], ARGV[i + 1]
+    lock[name] = NUMERIC[name] and tonumber(value) or value
+end
+store_lock(KEYS[1], lock)
+return 1
+"""
+
+# add minutes a lock was held for into stats of the day the lock ended
+# KEYS: channel stats
+# ARGV: channel, end tstamp, minutes, expiry of the stats
+LOCK_END_STATS = """
+local minutes = tonumber(ARGV[3])
+redis.call("HSETNX", KEYS[1], "channel_id", ARGV[1])
+redis.call("HSETNX", KEYS[1], "created_tstamp", ARGV[2])
+redis.call("HINCRBY", KEYS[1], "lock_minutes", minutes)
+local longest = tonumber(redis.call("HGET", KEYS[1], "longest_lock")) or 0
+if minutes > longest then
+    redis.call("HSET", KEYS[1], "longest_lock", minutes)
+end
+redis.call("EXPIREAT", KEYS[1], ARGV[4])
+"""
+
+# take a free lease or renew own one, a new holder gets a new fencing token
+# KEYS: lease, token counter
+# ARGV: identity, ttl (ms)
+ACQUIRE_LEASE = """
+local current = redis.call("GET", KEYS[1])
+if current then
+    local owner, token = string.match(current, "^(.*)|(%d+)$")
+    if owner ~= ARGV[1] then
+        return false
+    end
+    redis.call("PEXPIRE", KEYS[1], ARGV[2])
+    return tonumber(token)
+end
+
+local token = redis.call("INCR", KEYS[2])
+redis.call("SET", KEYS[1], ARGV[1] .. "|" .. token, "PX", ARGV[2])
+return token
+"""
+
+# give up own lease
+# KEYS: lease
+# ARGV: identity, fencing token
+RELEASE_LEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] .. "|" .. ARGV[2] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# claim a run for the leader holding the newest fencing token only
+# KEYS: run claim, token counter
+# ARGV: fencing token, ttl (s)
+CLAIM_RUN = """
+if redis.call("GET", KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+    return 1
+end
+return 0
+"""
@@ -1,27 +1,202 @@
-from typing import Optional, Tuple
+from itertools import count
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
 from . import config
 from .lock import Lock
+from .metrics import SLACK_SECONDS, SLACK_WAIT_SECONDS, slack_outcome
+from .tracing import span
+
+# lower value goes first when Slack calls have to wait for rate limits
+PRIORITY_HIGH = 0  # unlock & expiry notices
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # stats
+
+CHANNEL_METHODS = {"chat.postMessage"}  # Slack allows ~1 message/s in a channel
+
+
+class SlackError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or max(1.0, per_minute / 4)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        Return seconds to wait for a token to become available.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Dispatcher:
+    """
+    Pace Slack API calls by per-method and per-channel token buckets,
+    wait out 429 responses and let calls with higher priority go first.
+    """
+
+    def __init__(self, client, limits: Dict[str, int], channel_rate: int):
+        self.client = client
+        self.limits = limits
+        self.channel_rate = channel_rate
+        self.buckets: Dict[Tuple[str, Optional[str]], TokenBucket] = {}
+        self.blocked_until: Dict[str, float] = {}
+        self.waiting: Dict[str, List[tuple]] = {}  # (priority, order, channel)
+        self.counter = count()
+        self.cond = threading.Condition()
+
+    def bucket(self, method: str, channel: Optional[str]) -> Optional[TokenBucket]:
+        if channel and self.channel_rate:
+            rate = self.channel_rate
+        elif not channel and method in self.limits:
+            rate = self.limits[method]
+        else:
+            return None
+
+        key = (method if not channel else "channel", channel)
+        if key not in self.buckets:
+            if len(self.buckets) > 1000:
+                self.prune()
+            self.buckets[key] = TokenBucket(rate, 3 if channel else None)
+        return self.buckets[key]
+
+    def reset(self) -> None:
+        with self.cond:
+            self.buckets.clear()
+            self.blocked_until.clear()
+
+    def prune(self) -> None:
+        """
+        Forget buckets which are full again, they are equal to new ones.
+        """
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    def get_buckets(self, method: str, channel: Optional[str]) -> List[TokenBucket]:
+        buckets = [self.bucket(method, None)]
+        if channel:
+            buckets.append(self.bucket(method, channel))
+        return [x for x in buckets if x]
+
+    def channel_delay(self, method: str, channel: Optional[str], now: float) -> float:
+        bucket = self.bucket(method, channel) if channel else None
+        return bucket.delay(now) if bucket else 0
+
+    def get_delay(
+        self, ticket: tuple, method: str, channel: Optional[str]
+    ) -> Optional[float]:
+        """
+        Return seconds to wait, or None while a more important call can go. Calls
+        waiting for their busy channel dont hold up calls to other channels.
+        """
+        now = time.monotonic()
+        for other in self.waiting[method]:
+            if other < ticket and self.channel_delay(method, other[2], now) <= 0:
+                return None  # someone more important is waiting
+
+        delays = [
+            self.blocked_until.get(method, now) - now,
+            self.channel_delay(method, channel, now),
+        ]
+        bucket = self.bucket(method, None)
+        if bucket:
+            delays.append(bucket.delay(now))
+        return max(delays)
+
+    def acquire(self, method: str, channel: Optional[str], priority: int) -> None:
+        ticket = (priority, next(self.counter), channel)
+        with self.cond:
+            self.waiting.setdefault(method, []).append(ticket)
+            while True:
+                delay = self.get_delay(ticket, method, channel)
+                if delay is not None and delay <= 0:
+                    break
+                self.cond.wait(delay)
+
+            self.waiting[method].remove(ticket)
+            now = time.monotonic()
+            for bucket in self.get_buckets(method, channel):
+                bucket.take(now)
+            self.cond.notify_all()
+
+    def block(self, method: str, seconds: float) -> None:
+        with self.cond:
+            until = time.monotonic() + seconds
+            self.blocked_until[method] = max(self.blocked_until.get(method, 0), until)
+            self.cond.notify_all()
+
+    def call(self, method: str, priority: int = PRIORITY_NORMAL, **kwargs) -> dict:
+        channel = kwargs.get("channel") if method in CHANNEL_METHODS else None
+        for _ in range(max(1, config.SLACK_RATELIMIT_RETRIES)):
+            with SLACK_WAIT_SECONDS.labels(method).time():
+                self.acquire(method, channel, priority)
+
+            outcome = "exception"
+            start = time.perf_counter()
+            try:
+                with span(f"slack.{method}") as current:
+                    res = self.client.api_call(method, **kwargs)
+                    outcome = slack_outcome(res)
+                    if current and outcome != "ok":
+                        current.error = outcome
+            finally:
+                SLACK_SECONDS.labels(method, outcome).observe(
+                    time.perf_counter() - start
+                )
+
+            if outcome != "ratelimited":
+                return res
+
+            headers = {x.lower(): y for x, y in (res.get("headers") or {}).items()}
+            self.block(method, float(headers.get("retry-after", 1)))
+
+        return res
+
 
 bot = config.get_slackbot()
+if config.SLACK_PACING:
+    dispatcher = Dispatcher(bot, config.SLACK_RATE_LIMITS, config.SLACK_CHANNEL_RATE)
+else:
+    dispatcher = Dispatcher(bot, {}, 0)
+api_call = dispatcher.call
 
 
 def user_message(lock: Lock, **message_data) -> bool:
-    res_json = bot.api_call("im.open", user=lock.user_id)
+    res_json = api_call("im.open", user=lock.user_id)
 
     if not res_json["ok"]:
         return False
 
     channel = res_json["channel"]["id"]
 
-    res = bot.api_call("chat.postMessage", channel=channel, **message_data)
+    res = api_call("chat.postMessage", channel=channel, **message_data)
     return res["ok"]
 
 
 def react_message(lock: Lock, message_id: str, reaction: str) -> bool:
     try:
-        res = bot.api_call(
+        res = api_call(
             "reactions.add",
+            priority=PRIORITY_LOW,
             channel=lock.channel_id,
             name=reaction,
             timestamp=message_id,
@@ -33,9 +208,15 @@ def react_message(lock: Lock, message_id: str, reaction: str) -> bool:
 
 
 def channel_message(
-    channel_id: str, message: str, init_lock: bool = False, user: Optional[str] = None
+    channel_id: str,
+    message: str,
+    init_lock: bool = False,
+    user: Optional[str] = None,
+    priority: int = PRIORITY_NORMAL,
+    resource: Optional[str] = None,
 ) -> Tuple[bool, str]:
 
+    suffix = f"@{resource}" if resource else ""  # buttons of a named lock
     if init_lock:
         attachments: Optional[list] = [
             {
@@ -46,19 +227,19 @@ def channel_message(
                         "name": "lock",
                         "text": "+20",
                         "type": "button",
-                        "value": "lock_20",
+                        "value": f"lock_20{suffix}",
                     },
                     {
                         "name": "lock",
                         "text": "+40",
                         "type": "button",
-                        "value": "lock_40",
+                        "value": f"lock_40{suffix}",
                     },
                     {
                         "name": "unlock",
                         "text": "Unlock",
                         "type": "button",
-                        "value": "unlock",
+                        "value": f"unlock{suffix}",
                         "style": "primary",
                     },
                 ],
@@ -68,16 +249,18 @@ def channel_message(
         attachments = None
 
     if user:
-        res = bot.api_call(
+        res = api_call(
             "chat.postEphemeral",
+            priority=priority,
             channel=channel_id,
             text=message,
             attachments=attachments,
             user=user,
         )
     else:
-        res = bot.api_call(
+        res = api_call(
             "chat.postMessage",
+            priority=priority,
             channel=channel_id,
             text=message,
             attachments=attachments,
@@ -90,15 +273,16 @@ def update_channel_message(
     lock: Lock, message: str, unlock: bool = False
 ) -> Tuple[bool, Optional[str]]:
     if unlock:
-        res = bot.api_call(
+        res = api_call(
             "chat.update",
+            priority=PRIORITY_HIGH,
             channel=lock.channel_id,
             text=message,
             ts=lock.message_id,
             attachments=[],
         )
     else:
-        res = bot.api_call(
+        res = api_call(
             "chat.update", channel=lock.channel_id, text=message, ts=lock.message_id
         )
 
@@ -1,48 +1,331 @@
-from huey import crontab, RedisHuey
+from datetime import datetime
+import threading
+from typing import Callable, List
 
-from .channel_stats import get_stats, print_stats
+from huey import crontab
+from huey.api import PeriodicTask
+import arrow
+from prometheus_client import start_http_server
+
+from .channel_stats import (
+    ChannelStats,
+    iter_active_channels,
+    load_stats_batch,
+    print_stats,
+    record_lock_end,
+)
 from . import config
-from .lock import get_lock, Lock, mark_user_notified, remove_lock
-from .slackbot import channel_message
+from .events import record_event
+from .leader import elector, LeaderHuey
+from .lock import (
+    add_extension,
+    claim_announcement,
+    claim_refresh,
+    EXPIRE,
+    get_due_channels,
+    get_lock,
+    get_locks,
+    handoff_lock,
+    index_locks,
+    Lock,
+    mark_user_notified,
+    pop_extensions,
+    release_announcement,
+    release_refresh,
+    remove_from_index,
+    SUPERSEDED,
+    WARN,
+)
+from .metrics import QUEUE_PENDING, SWEEP_LOCKS, SWEEP_SECONDS, TASK_LAG_SECONDS
+from .slackbot import channel_message, PRIORITY_HIGH, react_message, SlackError
 
-huey = RedisHuey("rlock", url=config.REDIS_DB)
+huey = LeaderHuey("rlock", url=config.REDIS_DB)
 
 client = config.get_redis()
 
-# @huey.periodic_task(crontab(hour=17, minute=00))  # UTC
+QUEUE_PENDING.set_function(huey.pending_count)
+metrics_lock = threading.Lock()
+metrics_server = False
+
+
+@huey.periodic_task(crontab(hour=config.STATS_HOUR, minute=0))  # UTC
 def check_daily_stats():
-    keys = client.keys(f"{config.CHANNEL_STATS_PREFIX}*")
-    for channel in keys:
-        check_channel_stats(channel.decode("utf-8"))
+    """
+    Split the report of today stats into tasks of small batches of channels,
+    so other tasks like the expiry checks dont wait for the whole report.
+    """
+    now = arrow.now().timestamp
+    batches = iter_active_channels(now, config.STATS_BATCH)
+    for number, channel_ids in enumerate(batches):
+        report_stats(channel_ids, now, number * config.STATS_BATCH)
+
+
+@huey.task()
+def report_stats(channel_ids: List[str], tstamp: int, offset: int = 0):
+    """
+    Plan a post per channel spread out by the report rate, so the posts dont
+    wait for Slack in the workers & the queue stays free for other tasks.
+    """
+    stats = [x for x in load_stats_batch(channel_ids, tstamp) if x.locks_count]
+    for position, channel_stats in enumerate(stats, offset):
+        post_stats.schedule((channel_stats,), delay=position * 60 / config.STATS_RATE)
+
+
+@huey.task()
+def post_stats(stats: ChannelStats):
+    print_stats(stats)
+
+
+@huey.on_startup()
+def build_expiry_index():
+    index_locks()
 
 
-@huey.periodic_task(crontab(minute="*"))
+@huey.on_startup()
+def start_election():
+    elector.start()
+
+
+@huey.on_shutdown()
+def resign_leader():
+    elector.resign()
+
+
+@huey.on_startup()
+def serve_metrics():
+    """
+    Export metrics of the consumer, it runs startup hooks in each worker.
+    """
+    global metrics_server
+    with metrics_lock:
+        if config.TASKER_METRICS_PORT and not metrics_server:
+            start_http_server(config.TASKER_METRICS_PORT)
+            metrics_server = True
+
+
+@huey.pre_execute()
+def observe_lag(task):
+    if isinstance(task, PeriodicTask):  # enqueued at the start of a minute
+        planned = datetime.utcnow().replace(second=0, microsecond=0)
+    elif task.eta:
+        planned = task.eta
+    else:
+        return
+
+    lag = (datetime.utcnow() - planned).total_seconds()
+    TASK_LAG_SECONDS.labels(task.name).observe(max(0, lag))
+
+
+@huey.periodic_task(crontab(minute=f"*/{config.SWEEP_INTERVAL}"))
+@SWEEP_SECONDS.time()
 def check_expirations():
-    keys = client.keys(f"{config.CHANNEL_PREFIX}*")
-    for channel in keys:
-        lock = get_lock(channel, has_prefix=True)
-        check_channel_expiration(lock)
+    """
+    Safety net for locks whose scheduled checks got lost. Due channels are
+    handled by separate tasks, so a burst of expiries spreads over all workers.
+    """
+    lock_ids = get_due_channels()
+    SWEEP_LOCKS.labels("scanned").inc(len(lock_ids))
+    locks = get_locks(lock_ids)
+    for lock_id in lock_ids:
+        lock = locks.get(lock_id)
+        if not lock:
+            SWEEP_LOCKS.labels("orphaned").inc()
+            remove_from_index(lock_id)
+            continue
+
+        check_lock(lock_id, lock.version)
 
 
-def check_channel_expiration(lock: Lock):
+def check_channel_expiration(lock: Lock) -> bool:
+    """
+    Announce expiry of the lock or warn its owner, return whether it did any.
+    """
     if not lock:
-        return
+        return False
 
     if lock.is_expired:
-        if not lock.channel_notified:
-            lock.update_lock_message(unlock=True)
-            channel_message(lock.channel_id, lock.get_unlock_message("(expired)"))
+        return announce_once(lock, EXPIRE, announce_expiry)
+    elif lock.is_expiring and not lock.user_notified:
+        return announce_once(lock, WARN, warn_owner)
 
-        remove_lock(lock)
+    return False
 
-    elif lock.is_expiring and not lock.user_notified:
-        message = f"<@{lock.user_id}>, your lock will expire in about {lock.remaining} minutes."
-        if channel_message(lock.channel_id, message=message, user=lock.user_id):
-            mark_user_notified(lock)
+
+def announce_once(lock: Lock, kind: str, announce: Callable[[Lock], bool]) -> bool:
+    """
+    Run the announcement unless another worker has done it already, the claim
+    is given up when the announcement fails so it can be retried.
+    """
+    if not claim_announcement(lock, kind):
+        return False
+
+    try:
+        done = announce(lock)
+    except Exception:
+        release_announcement(lock, kind)
+        raise
+
+    if not done:
+        release_announcement(lock, kind)
+        return False
+
+    SWEEP_LOCKS.labels("acted").inc()
+    return True
+
+
+def announce_expiry(lock: Lock) -> bool:
+    """
+    Hand the expired lock off to the next one in queue & announce it. A lock
+    which wasnt taken over in time wasnt held by anyone, it's not counted.
+    """
+    status, next_lock = handoff_lock(lock)
+    if status == SUPERSEDED:
+        return False
+
+    if not lock.handoff:
+        record_lock_end(lock, lock.expiry_tstamp)
+        record_event(EXPIRE, lock)
+    if next_lock:
+        schedule_lock_checks(next_lock)
+
+    if not lock.channel_notified:
+        lock.update_lock_message(unlock=True)
+        extra_msg = "(not taken over)" if lock.handoff else "(expired)"
+        channel_message(
+            lock.channel_id,
+            lock.get_unlock_message(extra_msg, next_lock),
+            priority=PRIORITY_HIGH,
+        )
+
+    return True
+
+
+def warn_owner(lock: Lock) -> bool:
+    message = (
+        f"<@{lock.user_id}>, your lock {lock.label}will expire "
+        f"in about {lock.remaining} minutes."
+    )
+    success, _ = channel_message(lock.channel_id, message=message, user=lock.user_id)
+    if not success:
+        return False
+
+    mark_user_notified(lock)
+    return True
+
+
+def schedule_lock_checks(lock: Lock):
+    """
+    Plan expiry warning & expiration of a lock right at their time.
+    """
+    now = arrow.now().timestamp
+    args = (lock.lock_id, lock.version)
+    if not lock.user_notified:
+        check_lock.schedule(args, delay=max(0, lock.warn_tstamp - now) + 1)
+    if not config.EXPIRY_EVENTS:  # otherwise it's up to the listener
+        check_lock.schedule(args, delay=max(0, lock.expiry_tstamp - now) + 1)
+
+
+@huey.task()
+def check_lock(lock_id: str, version: int):
+    lock = get_lock(lock_id)
+    if lock and lock.version == version:  # otherwise superseded by extend/unlock
+        check_channel_expiration(lock)
+
+
+@huey.task()
+def check_channel(lock_id: str):
+    check_channel_expiration(get_lock(lock_id))
+
+
+# Outbox: Slack side effects of the requests, delivered by the tasker when
+# config.SLACK_SEND_LATER is enabled. Network errors & messages refused by
+# Slack are retried by huey.
+def outbox_task():
+    return huey.task(
+        retries=config.OUTBOX_RETRIES, retry_delay=config.OUTBOX_RETRY_DELAY
+    )
+
+
+def deliver(channel_id: str, message: str, **kwargs) -> str:
+    """
+    Post the message, raise when Slack refuses it so the task is retried.
+    """
+    success, msg_id = channel_message(channel_id, message, **kwargs)
+    if not success:
+        raise SlackError(f"message to {channel_id} not posted")
+    return msg_id
+
+
+@outbox_task()
+def announce_lock(lock: Lock, message: str):
+    msg_id = deliver(lock.channel_id, message, init_lock=True, resource=lock.resource)
+    current = get_lock(lock.lock_id)
+    if current and current.init_tstamp == lock.init_tstamp:
+        current.set_message_id(msg_id)
+
+
+def announce_extension(lock: Lock, lock_time: int):
+    """
+    Update the lock message & post about the extension. Extensions clicked
+    within EXTEND_MERGE seconds are posted at once, with their minutes summed.
+    """
+    schedule_refresh(lock.lock_id)
+    if not add_extension(lock.lock_id, lock_time):
+        return  # the post is planned already
+
+    if config.EXTEND_MERGE:
+        post_extensions.schedule((lock.lock_id,), delay=config.EXTEND_MERGE)
+    else:
+        post_extensions(lock.lock_id)
+
+
+@outbox_task()
+def post_extensions(lock_id: str):
+    minutes = pop_extensions(lock_id)
+    lock = get_lock(lock_id)
+    if not minutes or not lock:  # nothing to post or unlocked meanwhile
+        return
+
+    message = f"🔐 _LOCK extended_ {lock.label}({minutes} mins)"
+    try:
+        msg_id = deliver(lock.channel_id, message)
+    except Exception:
+        add_extension(lock_id, minutes)  # to be posted by the retry
+        raise
+
+    if msg_id:
+        react_message(lock, msg_id, "classic")
+
+
+def schedule_refresh(lock_id: str):
+    """
+    Update the lock message after a while, once for all the users queued up in
+    the meantime, instead of once per each of them.
+    """
+    if not claim_refresh(lock_id):
+        return
+
+    if config.REFRESH_DELAY:
+        refresh_lock_message.schedule((lock_id,), delay=config.REFRESH_DELAY)
+    else:
+        refresh_lock_message(lock_id)
+
+
+@outbox_task()
+def refresh_lock_message(lock_id: str):
+    release_refresh(lock_id)  # later changes plan another update
+    lock = get_lock(lock_id)
+    if lock and lock.message_id:
+        lock.update_lock_message()
+
+
+@outbox_task()
+def announce_unlock(lock: Lock, message: str):
+    if lock.message_id:
+        lock.update_lock_message(unlock=True)
+    deliver(lock.channel_id, message, priority=PRIORITY_HIGH)
 
 
-def check_channel_stats(channel_key: str):
-    channel_id = channel_key[len(config.CHANNEL_STATS_PREFIX) :]
-    stats = get_stats(channel_id)
-    if stats.is_today and stats.locks_count:
-        print_stats(stats)
+@outbox_task()
+def send_ephemeral(channel_id: str, message: str, user: str):
+    deliver(channel_id, message, user=user)
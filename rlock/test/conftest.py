@@ -3,7 +3,7 @@ from attr import asdict
 from starlette.testclient import TestClient
 import pytest
 
-from .. import config
+from .. import config, slackbot, tasker
 from ..webserver import app, Lock
 
 CHANNEL = "C1Q1NRYKX"
@@ -12,6 +12,20 @@ OTHER_USERID = USERID * 2
 SET_EXPIRY = arrow.now().shift(minutes=(config.EXPIRY_WARN - 1)).timestamp
 
 
+@pytest.fixture(autouse=True)
+def slack_dispatcher():
+    slackbot.dispatcher.reset()
+    yield slackbot.dispatcher
+
+
+@pytest.fixture
+def huey_immediate(monkeypatch):
+    """
+    Run tasks right away instead of enqueueing them.
+    """
+    monkeypatch.setattr(tasker.huey, "immediate", True)
+
+
 @pytest.fixture
 def test_client():
     return TestClient(app)
@@ -0,0 +1,78 @@
+import pytest
+
+from .. import cache, config, lock
+from .conftest import CHANNEL, USERID
+
+
+@pytest.fixture
+def lock_cache(monkeypatch):
+    monkeypatch.setattr(lock.lock_cache, "size", 10)
+    monkeypatch.setattr(cache, "listener", True)  # no other processes to listen to
+    lock.lock_cache.evict()
+    yield lock.lock_cache
+    lock.lock_cache.evict()
+
+
+def test_cached_lock(owned_redis, owned_lock, lock_cache):
+    hits = lock_cache.hits
+    assert lock.get_lock(CHANNEL).user_id == USERID
+    assert lock.get_lock(CHANNEL).user_id == USERID
+    assert lock_cache.hits == hits + 1
+
+    owned_lock.user_id = "foo"
+    owned_redis.set(owned_lock.full_id, lock.encode_lock(owned_lock))
+    assert lock.get_lock(CHANNEL).user_id == USERID  # still cached
+
+    lock.mark_user_notified(owned_lock)
+    assert lock.get_lock(CHANNEL).user_id == "foo"
+
+    lock.remove_lock(owned_lock)
+    assert not lock.get_lock(CHANNEL)
+
+
+def test_cache_bounds():
+    read_cache = cache.ReadCache("test", 2, -1)
+    for key in "abc":
+        read_cache.set(key, key, read_cache.token())
+    assert list(read_cache.items) == ["b", "c"]
+    assert read_cache.get("c") is cache.MISSING  # expired already
+
+    token = read_cache.token()
+    read_cache.evict("a")
+    read_cache.set("a", "a", token)
+    assert "a" not in read_cache.items
+
+
+def test_disabled_cache_publishes(clean_redis, monkeypatch):
+    read_cache = cache.ReadCache("test", 0, 60)
+    pubsub = clean_redis.pubsub()
+    pubsub.subscribe(config.CACHE_CHANNEL)
+    assert pubsub.get_message(timeout=1)["type"] == "subscribe"
+
+    monkeypatch.setattr(config, "CACHE_INVALIDATE", False)  # no process caches
+    read_cache.invalidate("a")
+    assert not pubsub.get_message(timeout=0.1)
+
+    monkeypatch.setattr(config, "CACHE_INVALIDATE", True)
+    read_cache.invalidate("a")  # other processes may have the cache enabled
+    message = pubsub.get_message(timeout=1)
+    pubsub.close()
+    assert message and message["data"] == b"test:a"
+
+
+def test_scripts_publish(clean_redis, owned_lock, monkeypatch):
+    pubsub = clean_redis.pubsub()
+    pubsub.subscribe(config.CACHE_CHANNEL)
+    assert pubsub.get_message(timeout=1)["type"] == "subscribe"
+
+    monkeypatch.setattr(config, "CACHE_INVALIDATE", True)
+    assert lock.acquire_lock(owned_lock) == lock.LOCKED
+    message = pubsub.get_message(timeout=1)
+    assert message and message["data"] == f"lock:{owned_lock.full_id}".encode()
+
+    other = lock.Lock(USERID, "C2", owned_lock.expiry_tstamp)
+    assert lock.acquire_locks([owned_lock, other])[0]
+    message = pubsub.get_message(timeout=1)
+    pubsub.close()
+    published = message["data"].decode().splitlines()
+    assert sorted(published) == sorted(f"lock:{x.full_id}" for x in [owned_lock, other])
@@ -0,0 +1,66 @@
+import arrow
+import pytest
+
+from .. import config, events, lock, slackbot, tasker
+from .conftest import CHANNEL, OTHER_USERID, USERID
+
+
+@pytest.fixture(autouse=True)
+def fake_slack(monkeypatch):
+    client = type("FakeSlack", (), {})()
+    client.api_call = lambda method, **kwargs: {"ok": True, "ts": "1.2"}
+    monkeypatch.setattr(slackbot.dispatcher, "client", client)
+
+
+def test_request_events(test_client, clean_redis, req_data, monkeypatch):
+    test_client.post("/lock", data=req_data)
+    test_client.post("/lock", data={**req_data, "trigger_id": ["2"]})
+    test_client.post(
+        "/lock", data={**req_data, "user_id": [OTHER_USERID], "trigger_id": ["3"]}
+    )
+    test_client.post("/unlock", data=req_data)
+
+    entries = clean_redis.execute_command("XRANGE", config.EVENTS_STREAM, "-", "+")
+    kinds = [dict(zip(x[1][::2], x[1][1::2]))[b"kind"] for x in entries]
+    assert kinds == [b"acquire", b"extend", b"queue", b"unlock"]
+
+    monkeypatch.setattr(config, "API_TOKEN", "secret")
+    headers = {"Authorization": "Bearer secret"}
+    params = {"channel": CHANNEL, "hours": 2}
+    assert test_client.get("/stats", params=params).status_code == 401
+    res = test_client.get("/stats", params=params, headers=headers)
+    assert res.status_code == 200
+    total = res.json()["total"]
+    assert (total["acquire"], total["extend"], total["queue"]) == (1, 1, 1)
+    assert total["unlock"] == 1
+    assert len(res.json()["hours"]) == 2
+    assert res.json()["contended"] == [{"channel_id": CHANNEL, "queue": 1}]
+
+    res = test_client.get("/stats", params={"user": OTHER_USERID}, headers=headers)
+    assert res.json()["total"]["queue"] == 1
+    assert not res.json()["total"]["acquire"]
+
+
+def test_expire_event(clean_redis, owned_lock):
+    now = arrow.now().timestamp
+    owned_lock.init_tstamp = now - 3600
+    owned_lock.expiry_tstamp = now - 60
+    owned_lock.user_notified = 1
+    lock.set_lock(owned_lock)
+    tasker.check_channel_expiration(lock.get_lock(CHANNEL))
+
+    total = events.get_rollup(1, user_id=USERID)["total"]
+    assert total["expire"] == 1
+    assert total["hold_minutes"] == 59
+    assert total["avg_hold_minutes"] == 59
+
+
+def test_rollup_hours(clean_redis, owned_lock):
+    now = arrow.now().timestamp
+    events.record_event(events.ACQUIRE, owned_lock, now=now - 3600)
+    events.record_event(events.ACQUIRE, owned_lock, now=now)
+
+    rollup = events.get_rollup(3, channel_id=CHANNEL)
+    assert [x["acquire"] for x in rollup["hours"]] == [0, 1, 1]
+    assert events.get_rollup(1)["total"]["acquire"] == 1
+    assert events.get_rollup(1, user_id=USERID)["total"]["acquire"] == 1
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from .. import config, leader, tasker
+
+
+def test_lease(clean_redis):
+    first = leader.LeaderElection("test_leader", 10)
+    second = leader.LeaderElection("test_leader", 10)
+
+    token = first.campaign()
+    assert token and first.is_leader
+    assert not second.campaign()
+    assert not second.is_leader
+    assert first.campaign() == token  # renewed
+
+    first.resign()
+    assert not first.is_leader
+    assert second.campaign() > token  # fenced out the previous leader
+    assert not first.campaign()
+
+
+def test_lapsed_lease(clean_redis):
+    first = leader.LeaderElection("test_leader", 10)
+    second = leader.LeaderElection("test_leader", 10)
+
+    token = first.campaign()
+    clean_redis.delete("test_leader")  # expired while first was stuck
+    assert second.campaign() == token + 1
+    assert not first.campaign()
+    assert not first.is_leader
+
+
+def test_periodic_from_leader(clean_redis, monkeypatch):
+    other = leader.LeaderElection(config.LEADER_KEY, 10)
+    monkeypatch.setattr(leader, "elector", other)
+    minute = datetime(2020, 1, 1, 0, 0)
+
+    other.campaign()
+    tasks = tasker.huey.read_periodic(minute)
+    assert [x.name for x in tasks] == ["check_expirations"]
+    assert not tasker.huey.read_periodic(minute)  # enqueued for the minute already
+
+    monkeypatch.setattr(leader, "elector", leader.LeaderElection(config.LEADER_KEY, 10))
+    assert not tasker.huey.read_periodic(minute.replace(minute=10))  # not leading
+
+
+def test_claim_fenced(clean_redis):
+    first = leader.LeaderElection("test_leader", 10)
+    second = leader.LeaderElection("test_leader", 10)
+
+    first.campaign()
+    assert first.claim("test_run:1", 10)
+    assert not first.claim("test_run:1", 10)  # claimed already
+
+    clean_redis.delete("test_leader")  # expired while first was stuck
+    second.campaign()
+    assert first.is_leader  # doesnt know yet
+    assert not first.claim("test_run:2", 10)
+    assert second.claim("test_run:2", 10)
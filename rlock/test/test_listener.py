@@ -0,0 +1,20 @@
+from .. import listener, lock
+
+
+def test_handle_event(mocker):
+    mock_check_channel = mocker.patch.object(listener, "check_channel")
+
+    assert not listener.handle_event({"data": b"channel_lock_C1Q1NRYKX"})
+    assert not mock_check_channel.called
+
+    assert listener.handle_event({"data": b"lock_ttl_C1Q1NRYKX"})
+    mock_check_channel.assert_called_once_with("C1Q1NRYKX")
+
+
+def test_lock_ttl(clean_redis, owned_lock):
+    lock.set_lock(owned_lock)
+    assert 0 < clean_redis.ttl(owned_lock.shadow_id) <= owned_lock.remaining * 60 + 61
+    assert clean_redis.ttl(owned_lock.full_id) > clean_redis.ttl(owned_lock.shadow_id)
+
+    lock.remove_lock(owned_lock)
+    assert not clean_redis.exists(owned_lock.shadow_id)
@@ -3,8 +3,24 @@ import json
 import arrow
 import pytest
 
-from .. import slackbot, tasker, webserver
-from ..lock import get_lock
+from .. import config, lock, slackbot, tasker, webserver
+from ..channel_stats import get_stats
+from ..lock import (
+    acquire_lock,
+    decode_lock,
+    encode_lock,
+    EXTENDED,
+    get_lock,
+    get_locks,
+    HANDED_OFF,
+    handoff_lock,
+    Lock,
+    LOCKED,
+    QUEUED,
+    QUEUED_ALREADY,
+    set_lock,
+    SUPERSEDED,
+)
 from .conftest import CHANNEL, OTHER_USERID, SET_EXPIRY, USERID
 
 
@@ -107,8 +123,424 @@ def test_dialock_nonowned_unlock(test_client, nonowned_redis, dialock_data):
 
 
 def test_get_unlock_message(owned_redis, owned_lock):
-    owned_lock.add_new_subscriber("foo")
-    owned_lock.add_new_subscriber("bar")
-    message = owned_lock.get_unlock_message()
-    assert "<@foo>" in message
-    assert "<@bar>" in message
+    for user_id in ("foo", "bar"):
+        waiting = Lock(user_id=user_id, channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+        assert acquire_lock(waiting) == QUEUED
+    assert owned_lock.get_subscribers() == ["`<@foo>`", "`<@bar>`"]
+
+    status, next_lock = handoff_lock(get_lock(CHANNEL))
+    assert status == HANDED_OFF
+    message = owned_lock.get_unlock_message(next_lock=next_lock)
+    assert "<@foo>, it's your turn" in message
+    assert "<@bar>" not in message
+    assert owned_lock.get_unlock_message() == "🔓 _unlock_ "
+
+
+def test_queue_handoff(clean_redis, owned_lock):
+    assert acquire_lock(owned_lock) == LOCKED
+    for user_id in ("U2", "U1", "U3"):
+        waiting = Lock(user_id=user_id, channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+        assert acquire_lock(waiting) == QUEUED
+    assert owned_lock.get_subscribers() == ["`<@U2>`", "`<@U1>`", "`<@U3>`"]
+
+    stale = get_lock(CHANNEL)
+    stale.version -= 1
+    assert handoff_lock(stale) == (SUPERSEDED, None)
+
+    status, next_lock = handoff_lock(get_lock(CHANNEL))
+    assert status == HANDED_OFF
+    assert (next_lock.user_id, next_lock.handoff) == ("U2", 1)
+    assert next_lock.duration == config.HANDOFF_WINDOW
+    assert get_lock(CHANNEL) == next_lock
+    assert next_lock.get_subscribers() == ["`<@U1>`", "`<@U3>`"]
+    assert lock.get_due_channels(next_lock.expiry_tstamp) == [CHANNEL]
+
+    # others cant take it meanwhile, the first one takes it over as a new lock
+    assert acquire_lock(owned_lock) == QUEUED
+    taken = Lock(user_id="U2", channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+    assert acquire_lock(taken) == LOCKED
+    assert (taken.expiry_tstamp, taken.handoff) == (SET_EXPIRY, 0)
+    assert taken.get_subscribers() == ["`<@U1>`", "`<@U3>`", f"`<@{USERID}>`"]
+
+
+def test_handoff_not_taken_over(clean_redis, owned_lock, huey_immediate, mocker):
+    mock_channel_message = mocker.patch.object(tasker, "channel_message")
+    acquire_lock(owned_lock)
+    acquire_lock(Lock(user_id="U1", channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY))
+    handoff_lock(get_lock(CHANNEL))
+
+    handed = get_lock(CHANNEL)
+    handed.expiry_tstamp = arrow.now().timestamp - 1
+    set_lock(handed)
+    tasker.check_channel_expiration(get_lock(CHANNEL))
+    assert "(not taken over)" in mock_channel_message.call_args[0][1]
+    assert not get_lock(CHANNEL)
+    assert not get_stats(CHANNEL).lock_minutes  # only the first lock counted
+
+
+def test_no_queue_jumping(clean_redis, owned_lock, nonowned_lock):
+    acquire_lock(owned_lock)
+    acquire_lock(nonowned_lock)
+    expired = get_lock(CHANNEL)
+    expired.expiry_tstamp = arrow.now().timestamp - 1
+    set_lock(expired)
+
+    late = Lock(user_id="U1", channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+    assert acquire_lock(late) == QUEUED
+    assert acquire_lock(nonowned_lock) == LOCKED
+    assert nonowned_lock.get_subscribers() == ["`<@U1>`"]
+
+
+def test_coalesced_refresh(test_client, clean_redis, owned_lock, req_data, mocker):
+    mock_schedule = mocker.patch.object(tasker.refresh_lock_message, "schedule")
+    mock_update = mocker.patch.object(
+        slackbot, "update_channel_message", return_value=(True, "1.2")
+    )
+    acquire_lock(owned_lock)
+    owned_lock.set_message_id("1.2")
+    for i, user_id in enumerate(("U1", "U2", "U3")):
+        data = {**req_data, "user_id": [user_id], "trigger_id": [str(i)]}
+        test_client.post("/lock", data=data)
+    assert mock_schedule.call_count == 1
+    assert not mock_update.called
+
+    tasker.refresh_lock_message.call_local(CHANNEL)
+    assert mock_update.call_count == 1
+    assert "Q: `<@U1>` `<@U2>` `<@U3>`" in mock_update.call_args[0][1]
+
+    test_client.post("/lock", data={**req_data, "user_id": ["U4"], "trigger_id": ["4"]})
+    assert mock_schedule.call_count == 2
+
+
+def test_merged_extensions(test_client, clean_redis, req_data, monkeypatch, mocker):
+    mock_schedule = mocker.patch.object(tasker.post_extensions, "schedule")
+    mock_channel_message = mocker.patch.object(
+        tasker, "channel_message", return_value=(True, "1.3")
+    )
+    mock_react = mocker.patch.object(tasker, "react_message")
+    mocker.patch.object(tasker.refresh_lock_message, "schedule")
+
+    for i in range(3):
+        test_client.post("/lock", data={**req_data, "trigger_id": [str(i)]})
+    assert mock_schedule.call_count == 1
+    assert not mock_channel_message.called
+
+    tasker.post_extensions.call_local(CHANNEL)
+    assert mock_channel_message.call_args[0][1] == "🔐 _LOCK extended_ (60 mins)"
+    assert mock_react.call_count == 1
+
+    monkeypatch.setattr(config, "EXTEND_MERGE", 0)
+    monkeypatch.setattr(config, "SLACK_SEND_LATER", True)
+    monkeypatch.setattr(tasker.huey, "immediate", True)
+    test_client.post("/lock", data={**req_data, "trigger_id": ["3"]})
+    assert mock_channel_message.call_args[0][1] == "🔐 _LOCK extended_ (30 mins)"
+    assert mock_schedule.call_count == 1
+
+
+def test_lock_message_single_fetch(owned_redis, owned_lock, mocker):
+    waiting = Lock(user_id="U1", channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+    assert acquire_lock(waiting) == QUEUED
+    spy = mocker.spy(lock.client, "zrange")
+    assert "Q: `<@U1>`" in owned_lock.get_lock_message()
+    assert spy.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("30 foo", (None, None, ["30", "foo"])),
+        ("deploying hotfix", (None, None, ["deploying", "hotfix"])),
+        ("staging-2 30 foo", ("staging-2", None, ["30", "foo"])),
+        ("staging-2 read 30", ("staging-2", lock.READ, ["30"])),
+        ("staging-2 write 30", ("staging-2", None, ["30"])),
+        ("read 30", (None, lock.READ, ["30"])),
+        ("some note 30", (None, None, ["some", "note", "30"])),
+    ],
+)
+def test_request_resource(text, expected):
+    assert webserver.get_request_resource(text.split()) == expected
+
+
+def test_named_locks(test_client, clean_redis, req_data):
+    named = lock.make_lock_id(CHANNEL, "staging-2")
+    test_client.post("/lock", data={**req_data, "text": ["staging-2 30 foo"]})
+    data = {**req_data, "user_id": [OTHER_USERID], "trigger_id": ["2"]}
+    test_client.post("/lock", data=data)
+
+    assert get_lock(named).user_id == USERID
+    assert (get_lock(named).resource, get_lock(named).extra_msg) == ("staging-2", "foo")
+    assert get_lock(CHANNEL).user_id == OTHER_USERID
+    assert get_lock(CHANNEL).resource is None
+    assert lock.get_due_channels(SET_EXPIRY + 3600) == [CHANNEL, named]
+
+    data = {**req_data, "text": ["staging-2"], "trigger_id": ["3"]}
+    assert test_client.post("/unlock", data=data).status_code == 204
+    assert not get_lock(named)
+    assert get_lock(CHANNEL)
+
+
+def test_read_lock(clean_redis):
+    def request(user_id, mode=lock.READ):
+        return Lock(
+            user_id=user_id,
+            channel_id=CHANNEL,
+            expiry_tstamp=SET_EXPIRY,
+            resource="db",
+            mode=mode,
+        )
+
+    first = request(USERID)
+    assert acquire_lock(first) == LOCKED
+    second = request(OTHER_USERID)
+    assert acquire_lock(second) == lock.SHARED
+    assert second.user_id == USERID  # owned by the first reader
+    assert first.get_readers() == sorted([USERID, OTHER_USERID])
+    assert acquire_lock(request(OTHER_USERID), 20) == EXTENDED
+    assert "read: " in get_lock(first.lock_id).get_lock_message()
+
+    # a writer waits for the readers, new readers dont overtake it
+    assert acquire_lock(request("U1", None)) == QUEUED
+    assert acquire_lock(request("U2")) == QUEUED
+
+    status, shared = handoff_lock(get_lock(first.lock_id), USERID)
+    assert status == lock.SHARED
+    assert (shared.user_id, shared.get_readers()) == (OTHER_USERID, [OTHER_USERID])
+
+    status, next_lock = handoff_lock(shared, OTHER_USERID)
+    assert (status, next_lock.user_id, next_lock.mode) == (HANDED_OFF, "U1", None)
+
+
+def test_dialock_resource(test_client, clean_redis, dialock_data):
+    named = Lock(
+        user_id=USERID, channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY, resource="db"
+    )
+    set_lock(named)
+    dialock_data["actions"][0]["value"] = "lock_20@db"
+    test_client.post("/dialock", data={"payload": [json.dumps(dialock_data)]})
+    assert get_lock(named.lock_id).expiry_tstamp == SET_EXPIRY + 20 * 60
+    assert not get_lock(CHANNEL)
+
+
+def test_legacy_ping_set(clean_redis, owned_lock, nonowned_lock):
+    acquire_lock(owned_lock)
+    clean_redis.sadd(owned_lock.ping_id, "U1")
+    assert owned_lock.get_subscribers() == ["`<@U1>`"]
+
+    assert acquire_lock(nonowned_lock) == QUEUED
+    assert owned_lock.get_subscribers() == ["`<@U1>`", f"`<@{OTHER_USERID}>`"]
+
+
+def test_get_locks(owned_redis, owned_lock):
+    locks = get_locks([CHANNEL, "C0FFEE"])
+    assert list(locks) == [CHANNEL]
+    assert locks[CHANNEL].user_id == USERID
+    assert locks[CHANNEL].expiry_tstamp == SET_EXPIRY
+
+    owned_lock.expiry_tstamp = 123
+    owned_lock.channel_notified = 1
+    set_lock(owned_lock)
+    assert not get_locks([CHANNEL])
+
+
+def test_acquire_lock(clean_redis, owned_lock, nonowned_lock):
+    assert acquire_lock(owned_lock) == LOCKED
+    assert acquire_lock(nonowned_lock) == QUEUED
+    assert acquire_lock(nonowned_lock) == QUEUED_ALREADY
+
+    assert acquire_lock(owned_lock, 20) == EXTENDED
+    assert owned_lock.expiry_tstamp == SET_EXPIRY + (20 * 60)
+    assert get_lock(CHANNEL).expiry_tstamp == SET_EXPIRY + (20 * 60)
+
+    stats = get_stats(CHANNEL)
+    assert stats.locks_count == 1
+    assert stats.extends_count == 1
+
+
+@pytest.fixture
+def send_later(monkeypatch):
+    monkeypatch.setattr(config, "SLACK_SEND_LATER", True)
+    tasker.huey.immediate = True
+    yield
+    tasker.huey.immediate = False
+
+
+def test_send_later_lock(test_client, req_data, clean_redis, send_later, mocker):
+    mock_channel_message = mocker.patch.object(
+        tasker, "channel_message", return_value=(True, "123.456")
+    )
+
+    response = test_client.post("/lock", data=req_data)
+    assert response.status_code == 204
+    assert mock_channel_message.call_args[1]["init_lock"]
+    assert get_lock(CHANNEL).message_id == "123.456"
+
+
+def test_send_later_unlock(
+    test_client, clean_redis, owned_lock, req_data, send_later, mocker
+):
+    owned_lock.message_id = "123.456"
+    set_lock(owned_lock)
+    mock_channel_message = mocker.patch.object(
+        tasker, "channel_message", return_value=(True, "123.789")
+    )
+    mock_update = mocker.patch.object(slackbot, "update_channel_message")
+
+    response = test_client.post("/unlock", data=req_data)
+    assert response.status_code == 204
+    assert not get_lock(CHANNEL)
+    assert "_unlock_" in mock_channel_message.call_args[0][1]
+    assert mock_update.call_args[1]["unlock"]
+
+
+def test_send_later_retried(test_client, req_data, clean_redis, send_later, mocker):
+    mocker.patch.object(tasker, "channel_message", return_value=(False, ""))
+
+    response = test_client.post("/lock", data=req_data)
+    assert response.status_code == 204
+    assert not get_lock(CHANNEL).message_id
+    retries = [x for x in tasker.huey.scheduled() if x.name == "announce_lock"]
+    assert len(retries) == 1
+    assert retries[0].retries == config.OUTBOX_RETRIES - 1
+
+    mocker.patch.object(tasker, "channel_message", return_value=(True, "123.456"))
+    retries[0].execute()
+    assert get_lock(CHANNEL).message_id == "123.456"
+
+
+def test_migrate_legacy_lock(owned_redis, owned_lock):
+    assert owned_redis.type(owned_lock.full_id) == b"hash"
+    owned_redis.expire(owned_lock.full_id, 3600)
+
+    lock = get_lock(CHANNEL)
+    assert lock.user_id == USERID
+    assert lock.expiry_tstamp == SET_EXPIRY
+    assert lock.message_id is None
+    assert owned_redis.type(owned_lock.full_id) == b"string"
+    assert owned_redis.ttl(owned_lock.full_id) > 3000
+
+    lock.set_message_id("123.456")
+    assert get_lock(CHANNEL).message_id == "123.456"
+    assert owned_redis.ttl(owned_lock.full_id) > 3000
+
+
+def test_packed_lock(owned_lock):
+    owned_lock.extra_msg = "foo"
+    assert decode_lock(encode_lock(owned_lock)) == owned_lock
+
+
+def test_retried_lock(test_client, clean_redis, req_data, mocker):
+    mock_channel_message = mocker.patch.object(
+        webserver, "channel_message", return_value=(True, "123.456")
+    )
+
+    first = test_client.post("/lock", data=req_data)
+    expiry = get_lock(CHANNEL).expiry_tstamp
+    retry = test_client.post("/lock", data=req_data, headers={"X-Slack-Retry-Num": "1"})
+    assert (retry.status_code, retry.text) == (first.status_code, first.text)
+    assert get_lock(CHANNEL).expiry_tstamp == expiry  # not extended
+    assert mock_channel_message.call_count == 1
+
+    test_client.post("/lock", data={**req_data, "trigger_id": ["another"]})
+    assert get_lock(CHANNEL).expiry_tstamp == expiry + (30 * 60)
+
+
+def test_retried_dialock(test_client, owned_redis, dialock_data, mocker):
+    mocker.patch.object(webserver, "channel_message", return_value=(True, "1.2"))
+    mocker.patch.object(slackbot, "update_channel_message", return_value=(True, 1))
+    dialock_data["actions"][0]["value"] = "lock"
+    req_data = {"payload": [json.dumps(dialock_data)]}
+
+    for _ in range(2):
+        assert test_client.post("/dialock", data=req_data).status_code == 204
+    assert get_lock(CHANNEL).expiry_tstamp == SET_EXPIRY + (30 * 60)
+
+
+def test_failed_request_retried(test_client, clean_redis, req_data, mocker):
+    mocker.patch.object(webserver, "acquire_lock", side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        test_client.post("/lock", data=req_data)
+
+    mocker.stopall()
+    mocker.patch.object(webserver, "channel_message", return_value=(True, "1.2"))
+    assert test_client.post("/lock", data=req_data).status_code == 204
+    assert get_lock(CHANNEL)
+
+
+def test_acquire_locks(clean_redis, nonowned_lock):
+    def request(*lock_ids):
+        return [
+            Lock(
+                user_id=USERID,
+                channel_id=lock.split_lock_id(x)[0],
+                resource=lock.split_lock_id(x)[1],
+                expiry_tstamp=SET_EXPIRY,
+            )
+            for x in lock_ids
+        ]
+
+    acquire_lock(nonowned_lock)
+    assert lock.acquire_locks(request("C2", CHANNEL, "C3:db")) == (
+        False,
+        {CHANNEL: OTHER_USERID},
+    )
+    assert not get_locks(["C2", "C3:db"])  # none taken when any is blocked
+
+    assert lock.acquire_locks(request("C2", "C3:db")) == (
+        True,
+        {"C2": LOCKED, "C3:db": LOCKED},
+    )
+    locks = request("C3:db", "C2", "C2")
+    assert lock.acquire_locks(locks)[1] == {"C2": EXTENDED, "C3:db": EXTENDED}
+    assert locks[0].resource == "db"
+    assert get_lock("C3:db").user_id == USERID
+    assert lock.get_due_channels(SET_EXPIRY) == [CHANNEL, "C2", "C3:db"]
+
+
+def test_acquire_locks_handoff(clean_redis, owned_lock):
+    assert acquire_lock(owned_lock) == LOCKED
+    waiting = Lock(user_id=OTHER_USERID, channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+    assert acquire_lock(waiting) == QUEUED
+    handoff_lock(get_lock(CHANNEL))
+
+    taken = Lock(user_id=OTHER_USERID, channel_id=CHANNEL, expiry_tstamp=SET_EXPIRY)
+    assert lock.acquire_locks([taken]) == (True, {CHANNEL: LOCKED})
+    assert (taken.expiry_tstamp, taken.handoff) == (SET_EXPIRY, 0)
+
+
+def test_acquire_locks_shared(clean_redis):
+    def request(user_id, mode=lock.READ):
+        return Lock(
+            user_id=user_id,
+            channel_id=CHANNEL,
+            expiry_tstamp=SET_EXPIRY,
+            mode=mode,
+        )
+
+    assert acquire_lock(request(USERID)) == LOCKED
+    assert acquire_lock(request(OTHER_USERID)) == lock.SHARED
+
+    blocked = {CHANNEL: OTHER_USERID}
+    assert lock.acquire_locks([request(USERID, None)]) == (False, blocked)
+    blocked = {CHANNEL: USERID}
+    assert lock.acquire_locks([request(OTHER_USERID, None)]) == (False, blocked)
+
+
+def test_locks_api(test_client, clean_redis, nonowned_lock, monkeypatch):
+    monkeypatch.setattr(config, "API_TOKEN", "secret")
+    headers = {"Authorization": "Bearer secret"}
+    data = {"user_id": USERID, "locks": ["C2", "C3:db"], "minutes": 20}
+
+    assert test_client.post("/locks", json=data).status_code == 401
+    res = test_client.post("/locks", json=data, headers=headers)
+    assert res.json() == {"locked": {"C2": LOCKED, "C3:db": LOCKED}}
+    assert get_lock("C2").remaining in (19, 20)
+
+    acquire_lock(nonowned_lock)
+    other = {"user_id": OTHER_USERID, "locks": ["C2", CHANNEL]}
+    res = test_client.post("/locks", json=other, headers=headers)
+    assert res.status_code == 409
+    assert res.json() == {"blocked": [{"lock_id": "C2", "user_id": USERID}]}
+
+    res = test_client.post("/locks/release", json=data, headers=headers)
+    assert res.json() == {"C2": "unlocked", "C3:db": "unlocked"}
+    assert not get_locks(["C2", "C3:db"])
@@ -0,0 +1,77 @@
+from prometheus_client import REGISTRY
+import pytest
+
+from .. import lock, metrics, slackbot, tasker
+from .conftest import CHANNEL
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture(autouse=True)
+def no_requests(monkeypatch):
+    monkeypatch.setattr(tasker, "channel_message", lambda *args, **kwargs: (True, 123))
+    monkeypatch.setattr(
+        slackbot, "update_channel_message", lambda *args, **kwargs: (True, 123)
+    )
+
+
+def test_metrics_endpoint(test_client, owned_redis):
+    before = sample("rlock_redis_seconds_count", method="get_lock", outcome="ok")
+    assert lock.get_lock(CHANNEL)
+
+    res = test_client.get("/metrics")
+    assert res.status_code == 200
+    assert "rlock_redis_seconds_bucket" in res.text
+    assert "rlock_queue_pending" in res.text
+    assert "rlock_cache_hits_total" in res.text
+    assert sample("rlock_redis_seconds_count", method="get_lock", outcome="ok") == (
+        before + 1
+    )
+    assert sample("rlock_request_seconds_count", path="metrics", status="200") >= 1
+
+
+def test_redis_error_outcome():
+    @metrics.observe_redis
+    def failing():
+        raise RuntimeError("down")
+
+    with pytest.raises(RuntimeError):
+        failing()
+    assert sample("rlock_redis_seconds_count", method="failing", outcome="error") == 1
+
+
+def test_slack_outcome(monkeypatch):
+    responses = iter([{"ok": False, "error": "ratelimited"}, {"ok": True}])
+    monkeypatch.setattr(slackbot.dispatcher, "client", type("", (), {})())
+    slackbot.dispatcher.client.api_call = lambda method, **kwargs: next(responses)
+    monkeypatch.setattr(slackbot.dispatcher, "block", lambda *args: None)
+    before = {
+        outcome: sample(
+            "rlock_slack_seconds_count", method="reactions.add", outcome=outcome
+        )
+        for outcome in ("ok", "ratelimited")
+    }
+
+    assert slackbot.api_call("reactions.add", channel="C1")["ok"]
+    for outcome, count in before.items():
+        assert (
+            sample("rlock_slack_seconds_count", method="reactions.add", outcome=outcome)
+            == count + 1
+        )
+
+
+def test_sweep_metrics(clean_redis, owned_lock, huey_immediate):
+    scanned = sample("rlock_sweep_locks_total", result="scanned")
+    acted = sample("rlock_sweep_locks_total", result="acted")
+    orphaned = sample("rlock_sweep_locks_total", result="orphaned")
+
+    lock.set_lock(owned_lock)  # due for expiry warning
+    lock.index_lock(lock.Lock("U1", "C1", expiry_tstamp=1), clean_redis)  # no lock
+    tasker.check_expirations.call_local()
+
+    assert sample("rlock_sweep_locks_total", result="scanned") == scanned + 2
+    assert sample("rlock_sweep_locks_total", result="acted") == acted + 1
+    assert sample("rlock_sweep_locks_total", result="orphaned") == orphaned + 1
+    assert sample("rlock_sweep_seconds_count") >= 1
@@ -1,10 +1,21 @@
+from threading import Thread
+import time
 from time import sleep
 
 import pytest
 
 from ..webserver import try_respond
 from .. import config
-from ..slackbot import channel_message, user_message
+from ..lock import acquire_lock, Lock
+from ..slackbot import (
+    channel_message,
+    Dispatcher,
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    TokenBucket,
+    user_message,
+)
 from ..tasker import check_channel_expiration
 
 
@@ -34,6 +45,73 @@ def test_update_message_on_subscribe(owned_lock):
 
     sleep(1)
 
-    owned_lock.add_new_subscriber("foooooo")
+    acquire_lock(Lock("foooooo", owned_lock.channel_id, owned_lock.expiry_tstamp))
 
     owned_lock.get_unlock_message()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(60, capacity=2)
+    now = bucket.updated
+    assert not bucket.delay(now)
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(1)
+    assert not bucket.delay(now + 1)
+
+
+def test_dispatcher_buckets():
+    dispatcher = Dispatcher(None, {"chat.update": 60, "chat.postMessage": 600}, 60)
+    dispatcher.acquire("chat.update", None, PRIORITY_NORMAL)
+    assert dispatcher.bucket("chat.update", None).tokens == pytest.approx(14)
+
+    dispatcher.acquire("chat.postMessage", "C1", PRIORITY_NORMAL)
+    assert dispatcher.bucket("chat.postMessage", None).tokens == pytest.approx(149)
+    assert dispatcher.bucket("chat.postMessage", "C1").tokens == pytest.approx(2)
+
+
+def test_dispatcher_busy_channel():
+    dispatcher = Dispatcher(None, {"chat.postMessage": 600}, 60)
+    for _ in range(3):
+        dispatcher.acquire("chat.postMessage", "C1", PRIORITY_NORMAL)
+
+    waiter = Thread(
+        target=dispatcher.acquire, args=("chat.postMessage", "C1", PRIORITY_HIGH)
+    )
+    waiter.start()
+    sleep(0.1)  # waiting for a token of C1 now
+    start = time.monotonic()
+    dispatcher.acquire("chat.postMessage", "C2", PRIORITY_LOW)
+    assert time.monotonic() - start < 0.5  # not queued behind C1
+    waiter.join()
+
+
+def test_dispatcher_ratelimited(mocker):
+    client = mocker.Mock()
+    client.api_call.side_effect = [
+        {"ok": False, "error": "ratelimited", "headers": {"Retry-After": "0"}},
+        {"ok": True, "ts": "123"},
+    ]
+    dispatcher = Dispatcher(client, {"chat.postMessage": 60}, 60)
+
+    res = dispatcher.call("chat.postMessage", channel="C1", text="foo")
+    assert res["ok"]
+    assert client.api_call.call_count == 2
+    assert "priority" not in client.api_call.call_args[1]
+
+
+def test_dispatcher_no_retries(mocker, monkeypatch):
+    monkeypatch.setattr(config, "SLACK_RATELIMIT_RETRIES", 0)
+    client = mocker.Mock()
+    client.api_call.return_value = {
+        "ok": False,
+        "error": "ratelimited",
+        "headers": {"retry-after": "0"},
+    }
+    dispatcher = Dispatcher(client, {"chat.postMessage": 60}, 60)
+    block = mocker.spy(dispatcher, "block")
+
+    res = dispatcher.call("chat.postMessage", channel="C1", text="foo")
+    assert res["error"] == "ratelimited"
+    assert client.api_call.call_count == 1
+    block.assert_called_once_with("chat.postMessage", 0.0)
@@ -1,31 +1,48 @@
+import arrow
+
 from .conftest import CHANNEL, OTHER_USERID, SET_EXPIRY, USERID
 
-from ..channel_stats import get_stats, save_stats
+from .. import config
+from ..channel_stats import get_stats, record_lock_end
+from ..lock import acquire_lock
 
 
-def test_marking():
+def test_empty_stats(clean_redis):
     stats = get_stats(CHANNEL)
-
-    assert not stats.locks_count
-
     assert stats.is_today
-
     assert not stats.locks_count
-    stats.mark_lock()
-    assert stats.locks_count == 1
-
     assert not stats.extends_count
-    stats.mark_extend()
-    assert stats.extends_count == 1
 
 
-def test_date_match():
-    stats = get_stats(CHANNEL)
-    stats.created_tstamp -= 3600 * 24
+def test_history_kept(clean_redis, owned_lock):
+    yesterday = arrow.now().shift(days=-1).timestamp
+    owned_lock.init_tstamp = yesterday - 10 * 60
+    record_lock_end(owned_lock, yesterday)
+
+    assert not get_stats(CHANNEL).lock_minutes  # today stats start anew
+    stats = get_stats(CHANNEL, yesterday)
+    assert stats.lock_minutes == 10
     assert not stats.is_today
-    stats.locks_count = 10
-    save_stats(stats)
+    assert clean_redis.ttl(stats.full_id) > (config.STATS_RETENTION - 1) * 24 * 3600
+
+
+def test_lock_minutes(clean_redis, owned_lock):
+    now = arrow.now().timestamp
+    owned_lock.init_tstamp = now - 40 * 60
+    record_lock_end(owned_lock, now)
+    owned_lock.init_tstamp = now - 20 * 60
+    record_lock_end(owned_lock, now)
 
     stats = get_stats(CHANNEL)
-    assert stats.is_today
+    assert stats.lock_minutes == 60
+    assert stats.longest_lock == 40
     assert not stats.locks_count
+
+
+def test_acquire_counts(clean_redis, owned_lock):
+    acquire_lock(owned_lock)
+    acquire_lock(owned_lock)
+
+    stats = get_stats(CHANNEL)
+    assert (stats.locks_count, stats.extends_count) == (1, 1)
+    assert clean_redis.ttl(stats.full_id) > 0
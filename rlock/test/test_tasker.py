@@ -1,6 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+from prometheus_client import REGISTRY
 import pytest
 
-from .. import lock, slackbot, tasker, webserver
+from .. import channel_stats, config, lock, slackbot, tasker, webserver
+from .conftest import USERID
 
 
 @pytest.fixture(autouse=True)
@@ -15,7 +20,9 @@ def no_requests(monkeypatch):
 
 
 def test_notify_upcoming_expiration(owned_redis, owned_lock, mocker):
-    mock_notify_upcoming_expiration = mocker.patch.object(tasker, "channel_message")
+    mock_notify_upcoming_expiration = mocker.patch.object(
+        tasker, "channel_message", return_value=(True, 123)
+    )
 
     assert owned_lock.is_expiring
     assert not owned_lock.user_notified
@@ -57,3 +64,112 @@ def test_valid_dont_notify(owned_redis, owned_lock, mocker):
     assert not owned_lock.user_notified
     assert not mock_channel_message.called
     assert not mock_remove_lock.called
+
+
+def test_expiry_index(clean_redis, owned_lock, huey_immediate, mocker):
+    mock_check = mocker.patch.object(tasker, "check_channel_expiration")
+
+    owned_lock.expiry_tstamp += 3600
+    lock.set_lock(owned_lock)
+    assert not lock.get_due_channels()
+
+    tasker.check_expirations.call_local()
+    assert not mock_check.called
+
+    owned_lock.expiry_tstamp -= 3600
+    lock.set_lock(owned_lock)
+    assert lock.get_due_channels() == [owned_lock.channel_id]
+
+    tasker.check_expirations.call_local()
+    assert mock_check.call_count == 1
+
+    lock.remove_lock(owned_lock)
+    assert not lock.get_due_channels()
+
+
+def test_index_existing_locks(owned_redis, owned_lock):
+    assert not lock.get_due_channels()
+    lock.index_locks()
+    assert lock.get_due_channels() == [owned_lock.channel_id]
+
+
+def test_check_lock_version(owned_redis, owned_lock, mocker):
+    mock_check = mocker.patch.object(tasker, "check_channel_expiration")
+
+    tasker.check_lock.call_local(owned_lock.channel_id, owned_lock.version + 1)
+    assert not mock_check.called
+
+    tasker.check_lock.call_local(owned_lock.channel_id, owned_lock.version)
+    assert mock_check.called
+
+
+def test_schedule_lock_checks(clean_redis, owned_lock):
+    assert lock.acquire_lock(owned_lock) == lock.LOCKED
+    assert owned_lock.version
+
+    tasker.schedule_lock_checks(owned_lock)
+    assert tasker.huey.pending_count() == 2
+
+
+def test_daily_stats(clean_redis, owned_lock, huey_immediate, monkeypatch, mocker):
+    mock_print = mocker.patch.object(tasker, "print_stats")
+    monkeypatch.setattr(config, "STATS_BATCH", 2)
+
+    for channel_id in ["C1", "C2", "C3"]:
+        lock.acquire_lock(lock.Lock(USERID, channel_id, owned_lock.expiry_tstamp))
+    now = arrow.now().timestamp
+    clean_redis.sadd(channel_stats.active_key(now), "C4")  # without any lock
+
+    tasker.check_daily_stats.call_local()
+    planned = tasker.huey.scheduled()
+    assert len({x.eta for x in planned}) == len(planned)  # spread out in time
+    for task in planned:
+        task.execute()
+    reported = sorted(x[0][0].channel_id for x in mock_print.call_args_list)
+    assert reported == ["C1", "C2", "C3"]
+
+
+def test_announce_once(owned_redis, owned_lock, mocker):
+    mock_channel_message = mocker.patch.object(tasker, "channel_message")
+    mock_channel_message.return_value = (False, "")  # failed, to be retried
+
+    labels = {"result": "acted"}
+    acted = REGISTRY.get_sample_value("rlock_sweep_locks_total", labels)
+    assert not tasker.check_channel_expiration(owned_lock)
+    assert REGISTRY.get_sample_value("rlock_sweep_locks_total", labels) == acted
+    assert mock_channel_message.call_count == 1
+    assert not lock.get_lock(owned_lock.channel_id).user_notified
+
+    mock_channel_message.return_value = (True, 123)
+    assert tasker.check_channel_expiration(owned_lock)
+    assert mock_channel_message.call_count == 2
+    assert lock.get_lock(owned_lock.channel_id).user_notified
+
+    # other workers checking the same lock in the meantime
+    assert not tasker.check_channel_expiration(owned_lock)
+    assert mock_channel_message.call_count == 2
+
+
+def test_warn_owner_slack_failed(owned_redis, owned_lock, monkeypatch):
+    monkeypatch.setattr(tasker, "channel_message", lambda *args, **kwargs: (False, ""))
+
+    assert not tasker.warn_owner(owned_lock)
+    assert not lock.get_lock(owned_lock.channel_id).user_notified
+
+    tasker.check_channel_expiration(owned_lock)
+    assert lock.claim_announcement(owned_lock, tasker.WARN)  # claim given up
+
+
+def test_parallel_expiry(clean_redis, owned_lock, huey_immediate, mocker):
+    mock_channel_message = mocker.patch.object(tasker, "channel_message")
+    mocker.patch.object(slackbot, "update_channel_message", return_value=(True, 1))
+    owned_lock.expiry_tstamp = arrow.now().timestamp - 60
+    lock.set_lock(owned_lock)
+    expired = lock.get_lock(owned_lock.channel_id)
+
+    with ThreadPoolExecutor(5) as pool:
+        done = list(pool.map(tasker.check_channel_expiration, [expired] * 5))
+
+    assert done.count(True) == 1
+    assert mock_channel_message.call_count == 1
+    assert not lock.get_lock(owned_lock.channel_id)
@@ -0,0 +1,71 @@
+import logging
+
+import pytest
+
+from .. import config, slackbot, tracing
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = tracing.MemoryExporter()
+    monkeypatch.setattr(tracing, "exporters", [exporter])
+    yield exporter
+
+
+@pytest.fixture
+def fake_slack(monkeypatch):
+    client = type("FakeSlack", (), {})()
+    client.api_call = lambda method, **kwargs: {"ok": True, "ts": "1.2"}
+    monkeypatch.setattr(slackbot.dispatcher, "client", client)
+
+
+def test_request_trace(test_client, clean_redis, req_data, exporter, fake_slack):
+    res = test_client.post("/lock", data=req_data)
+    assert res.status_code == 204
+
+    trace = exporter.traces[-1]
+    assert trace.root.name == "POST /lock"
+    names = [x.name for x in trace.spans]
+    for name in [
+        "rlock",
+        "extract_request",
+        "do_lock",
+        "redis.acquire_lock",
+        "slack.chat.postMessage",
+        "redis.set_message_id",
+    ]:
+        assert name in names
+
+    depths = {x.name: x.depth for x in trace.spans}
+    assert depths["do_lock"] == depths["rlock"] + 1
+    assert depths["redis.acquire_lock"] == depths["do_lock"] + 1
+    assert all(x.end for x in trace.spans)
+
+
+def test_log_slow_request(test_client, clean_redis, req_data, monkeypatch, caplog):
+    monkeypatch.setattr(config, "SLOW_REQUEST_MS", 10 ** 6)
+    with caplog.at_level(logging.WARNING, logger=tracing.__name__):
+        test_client.post("/unlock", data=req_data)
+    assert not caplog.records
+
+    monkeypatch.setattr(config, "SLOW_REQUEST_MS", 0)
+    with caplog.at_level(logging.WARNING, logger=tracing.__name__):
+        test_client.post("/unlock", data={**req_data, "trigger_id": ["2"]})
+    assert "slow request POST /unlock" in caplog.text
+    assert "redis.get_lock" in caplog.text
+
+
+def test_span_error(exporter):
+    with tracing.span("outside") as current:
+        assert current is None  # no trace, nothing recorded
+
+    with pytest.raises(ValueError):
+        with tracing.start_trace("root"):
+            with tracing.span("failing"):
+                raise ValueError()
+
+    trace = exporter.traces[-1]
+    assert [(x.name, x.error) for x in trace.spans] == [
+        ("root", "ValueError"),
+        ("failing", "ValueError"),
+    ]
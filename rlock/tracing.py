@@ -0,0 +1,168 @@
+"""
+Lightweight tracing of requests: spans of the handlers & of the Redis/Slack calls
+inside them. Finished traces go to exporters, by default only slow ones get
+logged with a per-step breakdown. Spans are mirrored to OpenTelemetry when it's
+installed & enabled.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+import logging
+import time
+from typing import Callable, Iterator, List, Optional
+
+import attr
+
+from . import config
+
+try:
+    from opentelemetry import trace as otel
+except ImportError:
+    otel = None
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(slots=True)
+class Span:
+    name: str = attr.ib()
+    depth: int = attr.ib(default=0)
+    start: float = attr.ib(factory=time.perf_counter)
+    end: Optional[float] = attr.ib(default=None)
+    error: Optional[str] = attr.ib(default=None)
+    trace: Optional["Trace"] = attr.ib(default=None, repr=False)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+
+@attr.s(slots=True)
+class Trace:
+    spans: List[Span] = attr.ib(factory=list)
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def breakdown(self) -> str:
+        return "\n".join(
+            "{}{:8.1f}ms {}{}".format(
+                "  " * x.depth,
+                x.duration * 1000,
+                x.name,
+                f" ({x.error})" if x.error else "",
+            )
+            for x in self.spans
+        )
+
+
+class MemoryExporter:
+    """
+    Keep the last finished traces, for tests & debugging.
+    """
+
+    def __init__(self, size: int = 100):
+        self.size = size
+        self.traces: List[Trace] = []
+
+    def __call__(self, trace: Trace) -> None:
+        self.traces.append(trace)
+        del self.traces[: -self.size]
+
+
+def log_slow(trace: Trace) -> None:
+    if trace.duration * 1000 >= config.SLOW_REQUEST_MS:
+        logger.warning(
+            "slow request %s took %.0fms:\n%s",
+            trace.root.name,
+            trace.duration * 1000,
+            trace.breakdown(),
+        )
+
+
+exporters: List[Callable[[Trace], None]] = [log_slow]
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def otel_span(name: str) -> Iterator[None]:
+    if otel is None or not config.TRACING_OTEL:
+        yield
+        return
+
+    with otel.get_tracer(__name__).start_as_current_span(name):
+        yield
+
+
+@contextmanager
+def record(new: Span) -> Iterator[Span]:
+    token = current_span.set(new)
+    try:
+        with otel_span(new.name):
+            yield new
+    except Exception as e:
+        new.error = type(e).__name__
+        raise
+    finally:
+        new.end = time.perf_counter()
+        current_span.reset(token)
+
+
+@contextmanager
+def start_trace(name: str) -> Iterator[Span]:
+    """
+    Trace a request, spans started within it are collected into the trace.
+    """
+    trace = Trace()
+    root = Span(name, trace=trace)
+    trace.spans.append(root)
+    try:
+        with record(root):
+            yield root
+    finally:
+        for exporter in exporters:
+            exporter(trace)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Optional[Span]]:
+    """
+    Measure a step of the current trace, does nothing outside of a trace.
+    """
+    parent = current_span.get()
+    if parent is None or parent.trace is None:
+        yield None
+        return
+
+    new = Span(name, depth=parent.depth + 1, trace=parent.trace)
+    parent.trace.spans.append(new)
+    with record(new):
+        yield new
+
+
+def traced(func):
+    """
+    Record calls of the function as spans.
+    """
+    if inspect.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(func.__name__):
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
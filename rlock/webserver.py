@@ -1,22 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hmac
 import json
+import time
 from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from starlette.responses import JSONResponse, PlainTextResponse, Response
-from typing import Tuple, Optional
+from typing import List, Tuple, Optional
 
 import arrow
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import uvicorn
 
-from .channel_stats import get_stats
 from . import config
-from .lock import get_lock, Lock, remove_lock, set_lock
+from .channel_stats import record_lock_end
+from .events import get_rollup, record_event, STATUS_EVENTS, UNLOCK
+from .idempotency import run_once
+from .lock import (
+    acquire_lock,
+    acquire_locks,
+    EXTENDED,
+    get_lock,
+    handoff_lock,
+    Lock,
+    make_lock_id,
+    QUEUED,
+    QUEUED_ALREADY,
+    READ,
+    SHARED,
+    split_lock_id,
+    SUPERSEDED,
+    WRITE,
+)
+from .metrics import REQUEST_SECONDS
 from .slackbot import channel_message, react_message
+from .tasker import (
+    announce_extension,
+    announce_lock,
+    announce_unlock,
+    schedule_lock_checks,
+    schedule_refresh,
+    send_ephemeral,
+)
+from .tracing import start_trace, traced
 
 app = Starlette(debug=False)
 
 client = config.get_redis()
 
 
+@app.on_event("startup")
+def setup_executor():
+    """
+    Redis & Slack calls are blocking, they run in a thread pool sized to the pools
+    of their connections, so they dont stall the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(config.WORKER_THREADS))
+
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        with start_trace(f"{request.method} {request.url.path}"):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        endpoint = request.scope.get("endpoint")
+        path = endpoint.__name__ if endpoint else "unknown"
+        REQUEST_SECONDS.labels(path, status).observe(time.perf_counter() - start)
+
+
+@app.route("/metrics")
+async def metrics(request: Request):
+    content = await run_in_threadpool(generate_latest)  # queue size is from Redis
+    return Response(content, media_type=CONTENT_TYPE_LATEST)
+
+
 def get_request_duration(params: list) -> int:
     """
     return timestamp when the lock will expiry
@@ -46,6 +110,30 @@ def get_request_message(params: list) -> str:
     return " ".join(params[offset:])
 
 
+def get_request_resource(params: list) -> Tuple[Optional[str], Optional[str], list]:
+    """
+    Split off name of the resource to lock & mode of the lock, given before
+    the duration as in `/rlock staging-2 read 30 smoke tests`. Without them, or
+    without the duration, the channel lock is meant.
+    """
+    for index, param in enumerate(params[:3]):
+        try:
+            int(param)
+        except ValueError:
+            continue
+        break
+    else:
+        return None, None, params
+
+    named, mode = params[:index], None
+    if named and named[-1].lower() in (READ, WRITE):
+        mode = READ if named.pop().lower() == READ else None
+    if len(named) > 1 or (not named and not mode):
+        return None, None, params
+
+    return (named[0] if named else None), mode, params[index:]
+
+
 def try_respond(
     lock: Lock, message: str, init_lock: bool = False
 ) -> Tuple[Response, str]:
@@ -54,7 +142,9 @@ def try_respond(
     If that fails, show message back to the user.
     """
     try:
-        success, msg_id = channel_message(lock.channel_id, message, init_lock=init_lock)
+        success, msg_id = channel_message(
+            lock.channel_id, message, init_lock=init_lock, resource=lock.resource
+        )
     except Exception:
         success, msg_id = False, ""
 
@@ -66,6 +156,14 @@ def try_respond(
     return PlainTextResponse(None, status_code=204), msg_id
 
 
+def ephemeral_message(channel_id: str, message: str, user: str):
+    if config.SLACK_SEND_LATER:
+        send_ephemeral(channel_id, message, user)
+    else:
+        channel_message(channel_id, message, user=user)
+
+
+@traced
 def extract_request(data: dict) -> Tuple[Lock, list]:
     """
     Extract data from the incoming command.
@@ -77,12 +175,15 @@ def extract_request(data: dict) -> Tuple[Lock, list]:
         params = data["text"].split()
     except Exception:
         params = []
+    resource, mode, params = get_request_resource(params)
 
     try:
         lock = Lock(
             channel_id=data["channel_id"],
             user_id=data["user_id"],
             expiry_tstamp=get_request_duration(params),
+            resource=resource,
+            mode=mode,
         )
     except IndexError:
         raise RuntimeError("invalid request")
@@ -91,6 +192,7 @@ def extract_request(data: dict) -> Tuple[Lock, list]:
 
 
 @app.route("/lock", methods=["POST"])
+@traced
 async def rlock(request: Request):
     """
     Attempt to set a lock in channel.
@@ -98,76 +200,112 @@ async def rlock(request: Request):
     form_data = await request.form()
     new_lock, params = extract_request(form_data)
     new_lock.extra_msg = get_request_message(params)
-    return do_lock(new_lock)
+    return await run_in_threadpool(
+        run_once, "lock", form_data.get("trigger_id"), do_lock, new_lock
+    )
 
 
+@traced
 def do_lock(new_lock: Lock, lock_time: Optional[int] = None):
-    old_lock = get_lock(new_lock.channel_id)
-    channel_stats = get_stats(new_lock.channel_id)
-    if old_lock and not old_lock.is_expired:
-        if old_lock.user_id != new_lock.user_id:
-            if old_lock.add_new_subscriber(new_lock.user_id):
-                return PlainTextResponse(
-                    "Currently locked, I will ping you when the lock will expire."
-                )
-            else:
-                return PlainTextResponse("Currently locked & ping planned already.")
-
-        lock_time = lock_time or 30
-        new_lock.expiry_tstamp = get_extension_timestamp(old_lock, lock_time)
-        new_lock.message_id = old_lock.message_id
-        new_lock.init_tstamp = old_lock.init_tstamp
-        new_lock.extra_msg = old_lock.extra_msg
-        new_lock.user_notified = 0
-        if set_lock(new_lock):
-            new_lock.update_lock_message()
-            response, msg_id = try_respond(
-                new_lock, f"🔐 _LOCK extended_ ({lock_time} mins)"
-            )
-            if msg_id:
-                channel_stats.mark_extend(save=True)
-                react_message(new_lock, msg_id, "classic")
-            return response
-
-    if set_lock(new_lock):
-        response, msg = try_respond(
-            new_lock, new_lock.get_lock_message(), init_lock=True
+    lock_time = lock_time or 30
+    user_id = new_lock.user_id  # the owner of a shared lock may be someone else
+    status = acquire_lock(new_lock, lock_time)
+    if status in STATUS_EVENTS:
+        record_event(STATUS_EVENTS[status], new_lock, user_id=user_id)
+    if status == QUEUED:
+        schedule_refresh(new_lock.lock_id)
+        return PlainTextResponse(
+            "Currently locked, I will ping you when the lock will expire."
+        )
+    elif status == QUEUED_ALREADY:
+        return PlainTextResponse("Currently locked & ping planned already.")
+    elif status == SHARED:
+        schedule_lock_checks(new_lock)
+        schedule_refresh(new_lock.lock_id)
+        return PlainTextResponse("Sharing the read lock with its other readers.")
+    elif status == EXTENDED:
+        schedule_lock_checks(new_lock)
+        if config.SLACK_SEND_LATER or config.EXTEND_MERGE:
+            announce_extension(new_lock, lock_time)
+            return PlainTextResponse(None, status_code=204)
+
+        new_lock.update_lock_message()
+        response, msg_id = try_respond(
+            new_lock, f"🔐 _LOCK extended_ {new_lock.label}({lock_time} mins)"
         )
-        if msg:  # was success
-            channel_stats.mark_lock(save=True)
+        if msg_id:
+            react_message(new_lock, msg_id, "classic")
         return response
 
+    schedule_lock_checks(new_lock)
+    if config.SLACK_SEND_LATER:
+        announce_lock(new_lock, new_lock.get_lock_message())
+        return PlainTextResponse(None, status_code=204)
+
+    response, _ = try_respond(new_lock, new_lock.get_lock_message(), init_lock=True)
+    return response
+
 
 @app.route("/unlock", methods=["POST"])
+@traced
 async def runlock(request: Request) -> Response:
     form_data = await request.form()
     new_lock, params = extract_request(form_data)
+    if not new_lock.resource and params and not params[0].lstrip("-").isdigit():
+        new_lock.resource = params[0]
 
-    return do_unlock(new_lock)
+    return await run_in_threadpool(
+        run_once, "unlock", form_data.get("trigger_id"), do_unlock, new_lock, True
+    )
 
 
-def do_unlock(lock: Lock):
-    old_lock = get_lock(lock.channel_id)
+@traced
+def do_unlock(lock: Lock, from_text: bool = False):
+    old_lock = get_lock(lock.lock_id)
+    if not old_lock and lock.resource and from_text:  # could be a note, not a name
+        lock.resource = None
+        old_lock = get_lock(lock.lock_id)
     if not old_lock:
         return PlainTextResponse("No lock set")
 
-    if old_lock.user_id != lock.user_id:
+    if not old_lock.is_holder(lock.user_id):
         return PlainTextResponse(f"Cant unlock, locked by <@{old_lock.user_id}>")
 
     try:
-        old_lock.update_lock_message(unlock=True)
+        status, next_lock = handoff_lock(old_lock, lock.user_id)
     except Exception:
-        pass
+        status, next_lock = SUPERSEDED, None
+    if status == SUPERSEDED:
+        return PlainTextResponse("Failed to unlock, try again")
+    elif status == SHARED:
+        schedule_lock_checks(next_lock)
+        schedule_refresh(next_lock.lock_id)
+        return PlainTextResponse("Left the read lock to its other readers.")
+
+    end_lock(old_lock, next_lock)
+    message = old_lock.get_unlock_message(next_lock=next_lock)
+    if config.SLACK_SEND_LATER:
+        announce_unlock(old_lock, message)
+        return PlainTextResponse(None, status_code=204)
 
     try:
-        remove_lock(lock)
+        old_lock.update_lock_message(unlock=True)
     except Exception:
-        return PlainTextResponse("Failed to unlock, try again")
+        pass
+
+    return try_respond(lock, message)[0]
+
 
-    return try_respond(lock, lock.get_unlock_message())[0]
+def end_lock(lock: Lock, next_lock: Optional[Lock]):
+    if not lock.handoff:
+        record_lock_end(lock, arrow.now().timestamp)
+        record_event(UNLOCK, lock)
+    if next_lock:
+        schedule_lock_checks(next_lock)
 
 
 @app.route("/dialock", methods=["POST"])
+@traced
 async def rdialog(request):
     try:
         form_data = await request.form()
@@ -178,27 +316,30 @@ async def rdialog(request):
     if payload["callback_id"] != "lock_expiry":
         return PlainTextResponse("invalid request")
 
+    request_id = payload.get("trigger_id") or payload.get("action_ts")
+    return await run_in_threadpool(run_once, "dialock", request_id, do_dialog, payload)
+
+
+@traced
+def do_dialog(payload: dict):
     channel_id = payload["channel"]["id"]
     request_user = payload["user"]["id"]
 
-    new_lock = get_lock(channel_id)
+    action, _, resource = payload["actions"][0]["value"].partition("@")
+    new_lock = get_lock(make_lock_id(channel_id, resource))
     if not new_lock:
-        channel_message(
-            channel_id, "chosen lock is not valid anymore", user=request_user
-        )
-        print("first")
+        ephemeral_message(channel_id, "chosen lock is not valid anymore", request_user)
         return PlainTextResponse(None, status_code=204)  # no lock exists
 
-    if new_lock.user_id != request_user:
-        channel_message(
-            channel_id, "can't interact with non-owned lock", user=request_user
+    if not new_lock.is_holder(request_user):
+        ephemeral_message(
+            channel_id, "can't interact with non-owned lock", request_user
         )
-        print("second", new_lock.user_id, request_user)
         return PlainTextResponse(
             None, status_code=204
         )  # cant interact with non-owned lock
 
-    action = payload["actions"][0]["value"]
+    new_lock.user_id = request_user  # can be any of readers of a read lock
     if action.startswith("lock"):
         try:
             action, _, lock_time = action.partition("_")
@@ -214,21 +355,131 @@ async def rdialog(request):
     return PlainTextResponse("nothing to do")
 
 
-@app.exception_handler(500)
-async def server_error(request, exc):
-    return PlainTextResponse("something went wrong", status_code=500)
+def is_authorized(request: Request) -> bool:
+    """
+    Check the bearer token of the API, which is disabled unless API_TOKEN is set.
+    """
+    header = request.headers.get("authorization", "")
+    expected = f"Bearer {config.API_TOKEN}"
+    return bool(config.API_TOKEN) and hmac.compare_digest(header, expected)
 
 
-def get_extension_timestamp(current_lock: Lock, lock_time: Optional[int] = None) -> int:
-    lock_time = lock_time or 30
-    if current_lock:
-        planned_expiry = (
-            arrow.get(current_lock.expiry_tstamp).shift(minutes=lock_time).timestamp
+def extract_api_request(data: dict) -> List[Lock]:
+    """
+    Extract locks from JSON like {"user_id": "U123", "locks": ["C123",
+    "C456:staging-2"], "minutes": 30, "message": "release 1.2"}.
+    """
+    minutes = abs(int(data.get("minutes", config.LOCK_DURATION)))
+    expiry = arrow.now().shift(minutes=+minutes).timestamp
+    locks = {}
+    for lock_id in data["locks"]:
+        channel_id, resource = split_lock_id(lock_id)
+        lock = Lock(
+            user_id=data["user_id"],
+            channel_id=channel_id,
+            expiry_tstamp=expiry,
+            resource=resource,
+            extra_msg=data.get("message"),
         )
-    else:
-        planned_expiry = arrow.now().shift(minutes=lock_time).timestamp
+        locks[lock.lock_id] = lock
+
+    if not locks:
+        raise RuntimeError("no locks")
+    return list(locks.values())
+
+
+@app.route("/locks", methods=["POST"])
+@traced
+async def rlocks(request: Request) -> Response:
+    """
+    Acquire locks of several channels at once for deploy pipelines, either all of
+    them or none when any is held by someone else.
+    """
+    if not is_authorized(request):
+        return PlainTextResponse("unauthorized", status_code=401)
+
+    try:
+        locks = extract_api_request(await request.json())
+    except Exception:
+        return PlainTextResponse("invalid request", status_code=400)
+
+    return await run_in_threadpool(do_locks, locks)
+
 
-    return planned_expiry
+@traced
+def do_locks(locks: List[Lock]) -> Response:
+    acquired, result = acquire_locks(locks)
+    if not acquired:
+        blocked = [{"lock_id": x, "user_id": y} for x, y in result.items()]
+        return JSONResponse({"blocked": blocked}, status_code=409)
+
+    for lock in locks:
+        status = result[lock.lock_id]
+        record_event(STATUS_EVENTS[status], lock)
+        schedule_lock_checks(lock)
+        if status == EXTENDED:
+            schedule_refresh(lock.lock_id)
+        else:
+            announce_lock(lock, lock.get_lock_message())
+
+    return JSONResponse({"locked": result})
+
+
+@app.route("/locks/release", methods=["POST"])
+@traced
+async def runlocks(request: Request) -> Response:
+    """
+    Release locks of several channels, answering what /runlock would for each.
+    """
+    if not is_authorized(request):
+        return PlainTextResponse("unauthorized", status_code=401)
+
+    try:
+        locks = extract_api_request(await request.json())
+    except Exception:
+        return PlainTextResponse("invalid request", status_code=400)
+
+    return await run_in_threadpool(do_unlocks, locks)
+
+
+@traced
+def do_unlocks(locks: List[Lock]) -> Response:
+    result = {}
+    for lock in locks:
+        response = do_unlock(lock)
+        if response.status_code == 204 or isinstance(response, JSONResponse):
+            result[lock.lock_id] = "unlocked"
+        else:
+            result[lock.lock_id] = response.body.decode("utf-8")
+
+    return JSONResponse(result)
+
+
+@app.route("/stats")
+async def stats(request: Request):
+    """
+    Lock analytics of the last hours, optionally of a single channel or user.
+    """
+    if not is_authorized(request):
+        return PlainTextResponse("unauthorized", status_code=401)
+
+    try:
+        hours = min(int(request.query_params.get("hours", 24)), 24 * 31)
+    except ValueError:
+        return PlainTextResponse("invalid hours", status_code=400)
+
+    rollup = await run_in_threadpool(
+        get_rollup,
+        max(hours, 1),
+        channel_id=request.query_params.get("channel"),
+        user_id=request.query_params.get("user"),
+    )
+    return JSONResponse(rollup)
+
+
+@app.exception_handler(500)
+async def server_error(request, exc):
+    return PlainTextResponse("something went wrong", status_code=500)
 
 
 if __name__ == "__main__":
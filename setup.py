@@ -8,7 +8,7 @@ setup(
     name="releaselock",
     version="0.6.0",
     description="Slack App for managing release mutex",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     include_package_data=True,
     install_requires=requirements,
 )